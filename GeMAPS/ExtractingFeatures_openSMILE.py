@@ -4,10 +4,10 @@ Run this file to extract eGeMAPS features using openSMILE.
 Recommended to run on Ponyland, see ExtractingFeatures_openSMILE_instructions.txt
 
 Input: folder with .wav files and folder with TextGrid files
-Output: excel file with all features
+Output: table with all features (.parquet by default, see tableextension)
 
 Things to change depending on your data:
-indir, outdir, opensmiledir, opensmile, tier, typeOfSpeech, textgriddir, textgridextensions, config, featureset
+indir, outdir, opensmiledir, opensmile, tier, typeOfSpeech, textgriddir, textgridextensions, config, featureset, workers, outputformat, tableextension
 
 @author: Loes van Bemmel
 @date created: 11-10-2020
@@ -15,12 +15,22 @@ indir, outdir, opensmiledir, opensmile, tier, typeOfSpeech, textgriddir, textgri
 """
 
 #Imports
-from praatio import tgio 
 import subprocess
 import os
 import arff #see instructions if it gives an error here 
 import numpy as np 
 import pandas as pd
+import sys
+import tempfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+#The decoded-audio cache is shared with run_LabeledSegmentsAnalysis_v3.py in the directory above
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from audio_cache import AudioCache
+from feature_tables import write_table
+from sharding import file_size, parse_shard, select_shard, shard_table_path
+from textgrid_index import load_textgrid
 
 #THINGS THAT POSSIBLY NEED TO CHANGE
 #Directories: change these if necessary
@@ -34,6 +44,22 @@ tier = 'word'
 typeOfSpeech = 'Reference' 
 opensmile = opensmiledir+"./SMILExtract" #change this according to your location of SMILExtract file in opensmile directory
 
+#Decoded-audio cache (see audio_cache.py): set to the same directory as --audioCache of
+#run_LabeledSegmentsAnalysis_v3.py to decode every (mp3) file only once for both pipelines.
+#None: SMILExtract reads the files in indir directly
+audiocachedir = None
+audiocachesize = 50 #GB
+
+#Number of files that are extracted at the same time (number of SMILExtract processes)
+#Every file gets its own copy of the configuration in a temporary directory, so parallel files
+#(and separate runs of this script) never overwrite each other's FrameModeFunctionals file
+workers = 1
+
+#Sharding for cluster array jobs (see sharding.py): "i/N" only extracts shard i (counted from 0) of N, balanced
+#on the size of the audio files, and writes it to a table of its own; combine the shards with merge_shards.py.
+#Can also be given on the command line: --shard i/N
+shard = None
+
 #This should be correct: do not change
 frameModeFunctionals = opensmiledir+"config/shared/FrameModeFunctionals.conf.inc"
 
@@ -46,6 +72,15 @@ frameModeFunctionals = opensmiledir+"config/shared/FrameModeFunctionals.conf.inc
 config = opensmiledir+"config/gemaps/eGeMAPSv01a.conf" #eGeMAPS, might need to be changed, check your own opensmile directory!
 featureset = "eGeMAPS"
 
+#The format of the result files of openSMILE
+#"csv": written with -csvoutput and loaded directly as float32 columns (fast)
+#"arff": written with -O and loaded with the arff package (use this if your configuration has no -csvoutput option)
+outputformat = "csv"
+
+#The format of the table with all features (see feature_tables.py)
+#".parquet" or ".feather" (fast, no row limit), ".xlsx" or ".tsv" to export it to Excel or other tools
+tableextension = ".parquet"
+
 
 """
 createFrameModeFunctionals 
@@ -54,14 +89,17 @@ createFrameModeFunctionals
             please ensure that the extension above is correct
         tier = either 'phoneme' or 'word'
         
+        framemodefilename = the FrameModeFunctionals file to write, see createJobConfig
+        
     output:
         a new FrameModeFunctionals.conf.inc file that uses the force aligned intervals to calculate 
         openSMILE features rather than a pre-set sliding window
+        returns the intervals as a list of (start, stop, label)
 
 """
-def createFrameModeFunctionals(file_name, tier): 
+def createFrameModeFunctionals(file_name, tier, framemodefilename=frameModeFunctionals): 
     if(tier == 'full'): #standard FrameModeFunctionals file
-        framemodefile = open(frameModeFunctionals, "w")
+        framemodefile = open(framemodefilename, "w")
         framemodefile.write("frameMode = full \nframeSize = 0 \nframeStep = 0\nframeCenterSpecial = left")
         framemodefile.close()
         return [] 
@@ -83,22 +121,15 @@ def createFrameModeFunctionals(file_name, tier):
             print("The textgrid for ", file_name, " does not exist in the given directory! Please add it!")
             return []
 
-        tg = tgio.openTextgrid(file)
-        tierList = tg.tierDict[tg.tierNameList[index]]
-
-        intervalstring = ""
-        labellist = []
-        
-        for start, stop, label in tierList.entryList:
-            intervalstring += str(start)+"s-"+str(stop)+"s,"
-            labellist.append(label)
-            
-        intervalstring = intervalstring[0:-1] #not the last comma
-        framemodefile = open(frameModeFunctionals, "w")
+        #The intervals with a label, read with the TextGrid index that the Praat features use as well (see textgrid_index.py)
+        starts, stops, labels = load_textgrid(file).intervals(index+1) #Praat counts tiers from 1
+        intervallist = list(zip(starts.tolist(), stops.tolist(), labels.tolist()))
+        intervalstring = ",".join([str(start)+"s-"+str(stop)+"s" for start, stop, label in intervallist])
+        framemodefile = open(framemodefilename, "w")
         framemodefile.write("frameMode = list \nframeList = "+str(intervalstring)+" \nframeCenterSpecial = left")
         framemodefile.close()
     
-    return labellist
+    return intervallist
     
 def getFiles(indir, outdir):
     #Getting files from indir and creating the outdir
@@ -113,54 +144,142 @@ def getFiles(indir, outdir):
     print("\nExtracting features from ", len(os.listdir(indir))," files.") 
     return filenames
     
-#Generating and running the commands
-def createFeatures(filenames):
-    finaldf = None
-    for file in filenames: #for each input file
-        resultname = file[0:-4]+"_openSMILE_"+featureset+"_"+tier+"tier_results"
-        resultname = outdir+resultname
-        command = opensmile + " -C " + config +" -I " +indir+file + " -O " + resultname
+"""
+createJobConfig
+    input:
+        jobdir = an empty (temporary) directory for one run of SMILExtract
+        
+    output:
+        the path of the configuration in jobdir and the path of the FrameModeFunctionals file it includes.
+        The openSMILE config directory is mirrored in jobdir with links to the original files, except for
+        the FrameModeFunctionals file, which can then be written for this run only.
+        The directories on the way to config and frameModeFunctionals are real directories, so relative
+        includes such as ../shared/FrameModeFunctionals.conf.inc are found in jobdir as well.
+
+"""
+def createJobConfig(jobdir):
+    configroot = os.path.abspath(opensmiledir+"config")
+    targets = [os.path.abspath(config), os.path.abspath(frameModeFunctionals)]
+
+    def mirror(directory, jobdirectory):
+        os.makedirs(jobdirectory, exist_ok=True)
+        for entry in os.listdir(directory):
+            path = os.path.join(directory, entry)
+            if(any(target.startswith(path+os.sep) for target in targets)):
+                mirror(path, os.path.join(jobdirectory, entry)) #on the way to config or frameModeFunctionals
+            elif(path != targets[1]):
+                os.symlink(path, os.path.join(jobdirectory, entry))
+
+    mirror(configroot, os.path.join(jobdir, "config"))
+    jobconfig = os.path.join(jobdir, "config", os.path.relpath(targets[0], configroot))
+    jobframemodefunctionals = os.path.join(jobdir, "config", os.path.relpath(targets[1], configroot))
+    return jobconfig, jobframemodefunctionals
+
+"""
+loadCsvResults
+    input:
+        resultname = a result file written by SMILExtract with -csvoutput
+        
+    output:
+        a dataframe with one row per frame, with the name column as text and all other columns as float32
+        
+"""
+def loadCsvResults(resultname):
+    with open(resultname) as resultfile:
+        columns = resultfile.readline().rstrip("\n").split(";")
+    dtypes = dict.fromkeys(columns[1:], np.float32)
+    dtypes[columns[0]] = str
+    return pd.read_csv(resultname, sep=";", dtype=dtypes)
+
+def loadArffResults(resultname):
+    with open(resultname) as resultfile:
+        dataset = arff.load(resultfile)
+    data = np.array(dataset['data'])
+    df = pd.DataFrame(data)
+    df.columns = dataset['attributes']    
+    df.columns = list([c[0] for c in list(df.columns)])
+    return df
+
+#Running SMILExtract for one file and loading its results
+def extractFile(file, audiocache):
+    resultname = file[0:-4]+"_openSMILE_"+featureset+"_"+tier+"tier_results"
+    resultname = outdir+resultname
+    inputfile = indir+file
+    if(audiocache is not None):
+        inputfile = audiocache.path(inputfile) #decoded mono WAV file that SMILExtract can read
+
+    with tempfile.TemporaryDirectory() as jobdir:
+        jobconfig, jobframemodefunctionals = createJobConfig(jobdir)
+        if(outputformat == "csv"):
+            resultname += ".csv"
+            command = opensmile + " -C " + jobconfig +" -I " +inputfile + " -csvoutput " + resultname
+        else:
+            command = opensmile + " -C " + jobconfig +" -I " +inputfile + " -O " + resultname
 
         print(command)
-        labellist = createFrameModeFunctionals(file[0:-4], tier) #creating the FrameModeFunctionals file to ensure correct timeframes
-        if((len(labellist) == 0) and (tier != "full")):
+        intervallist = createFrameModeFunctionals(file[0:-4], tier, jobframemodefunctionals) #creating the FrameModeFunctionals file to ensure correct timeframes
+        if((len(intervallist) == 0) and (tier != "full")):
             print("Something went wrong with the labellist in createFeatures. Please ensure that the textgrid files are correct.")
-            continue #if somehow it doesn't work; skip! 
+            return None #if somehow it doesn't work; skip! 
         
-        #Delete the file if it already exists
+        #Delete the file if it already exists (openSMILE appends to it)
         if(os.path.exists(resultname)):
             os.remove(resultname)
 
         subprocess.run(command, shell=True)
 
-        #load the arff dataset
-        dataset = arff.load(open(resultname))
-        data = np.array(dataset['data'])
-        df = pd.DataFrame(data)
-        df.columns = dataset['attributes']    
-        df.columns = list([c[0] for c in list(df.columns)])
-        df['name'] = file[0:-4]
-
-        #The words/phonemes are only if you do not use the entire file; of course.
-        if(tier != "full"):
-            #Sometimes openSMILE doesn't calculate features for the last few milliseconds
-            #So delete those last utterances from the labellist as well 
-            if(len(labellist) > len(data)):
-                difference = len(data) - len(labellist) #usually just 1! But could be more 
-                labellist = labellist[0:difference] 
-
-            df['word'] = labellist
-
-        df['class'] = typeOfSpeech
-        finaldf = pd.concat([finaldf, df])
+    #load the results
+    if(outputformat == "csv"):
+        df = loadCsvResults(resultname)
+    else:
+        df = loadArffResults(resultname)
+    df['name'] = file[0:-4]
+
+    #The words/phonemes are only if you do not use the entire file; of course.
+    if(tier != "full"):
+        #Sometimes openSMILE doesn't calculate features for the last few milliseconds
+        #So delete those last utterances from the intervallist as well 
+        if(len(intervallist) > len(df)):
+            difference = len(df) - len(intervallist) #usually just 1! But could be more 
+            intervallist = intervallist[0:difference] 
+
+        #start and end are used to combine the segments with the Praat features, see combining_praat_gemaps.py
+        df['word'] = [label for start, stop, label in intervallist]
+        df['start'] = [start for start, stop, label in intervallist]
+        df['end'] = [stop for start, stop, label in intervallist]
+
+    df['class'] = typeOfSpeech
+    return df
     
-    return finaldf 
+#Generating and running the commands
+def createFeatures(filenames):
+    audiocache = None
+    if(audiocachedir is not None):
+        audiocache = AudioCache(audiocachedir, int(audiocachesize * 1024 ** 3))
+
+    #map returns the results in the order of filenames, whichever file finishes first
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        dataframes = list(executor.map(lambda file: extractFile(file, audiocache), filenames))
+
+    dataframes = [df for df in dataframes if df is not None]
+    if(len(dataframes) == 0): #e.g. a shard without files
+        return pd.DataFrame()
+    return pd.concat(dataframes)
     
     
+parser = argparse.ArgumentParser("Message")
+parser.add_argument("--shard", type=str, default=shard, help = "Only extract shard i of N (i/N, i counts from 0), e.g. the task id of an array job")
+args = parser.parse_args()
+
 filenames = getFiles(indir, outdir)
+output_name = outdir+featureset+"_"+tier+"level_"+typeOfSpeech+tableextension
+if(args.shard is not None):
+    shardindex, shardcount = parse_shard(args.shard)
+    filenames = select_shard(filenames, filenames, [file_size(indir+file) for file in filenames], (shardindex, shardcount))
+    output_name = shard_table_path(output_name, shardindex, shardcount)
+    print("Shard", shardindex, "of", shardcount, ":", len(filenames), "files.")
 dataframe = createFeatures(filenames)
-#Save to disk as excel file
-output_name = outdir+featureset+"_"+tier+"level_"+typeOfSpeech+".xlsx"
-dataframe.to_excel(output_name, index=False)
+#Save to disk
+write_table(dataframe, output_name)
 print("The file "+ output_name + " is created.")
 print("--------------------------------------------------------------------------------")  
\ No newline at end of file
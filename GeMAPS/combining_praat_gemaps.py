@@ -2,11 +2,11 @@
 """
 Run this file to combine the Praat and (e)GeMAPS features.
 
-Input: folders with excel files containg Praat and openSMILE features
-Output: excel file with combined features
+Input: tables (.parquet, .feather, .xlsx or .tsv) containing Praat and openSMILE features
+Output: table with combined features (see feature_tables.py)
 
 Things to change depending on your data:
-filenames, output_name, removeOutliers
+filenames, output_name, removeOutliers, timeTolerance, partitionByParticipant
 
 @author: Loes van Bemmel
 @date created: 20-4-2021
@@ -17,20 +17,90 @@ filenames, output_name, removeOutliers
 import numpy as np
 import pandas as pd
 import os
+import sys
 
-filenames = ["results/praat_wordlevel_Reference.xlsx", 
-            "results/eGeMAPS_wordlevel_Reference.xlsx"
+#The table I/O is shared with organizing_PraatFeatures.py in the directory above
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from feature_tables import read_table, write_table
+
+#The format of every table follows its extension: .parquet, .feather, .xlsx or .tsv
+filenames = ["results/praat_wordlevel_Reference.parquet", 
+            "results/eGeMAPS_wordlevel_Reference.parquet"
             ]
             
-output_name = "results/wordlevel_Reference.xlsx"
+output_name = "results/wordlevel_Reference.parquet"
 removeOutliers = True
 
+#Write a .parquet output_name as a directory with one partition per participant
+#(needs a participant column, as in the Praat features)
+partitionByParticipant = False
+
+#Segments of two feature sets are combined when they belong to the same file and their start and end times
+#differ at most timeTolerance seconds. If a feature set has no start and end times (e.g. Praat .txt results),
+#the n-th occurrence of a word in a file is combined with the n-th occurrence of that word in the other set.
+timeTolerance = 0.01
+
+
+#The columns on which the segments of two feature sets are combined
+def joinKeys(df1, df2):
+    if all(column in df1.columns and column in df2.columns for column in ['start', 'end']):
+        return ['file_name', 'start', 'end']
+    if 'word' in df1.columns and 'word' in df2.columns:
+        return ['file_name', 'word', 'occurrence']
+    return ['file_name', 'occurrence']
+
+#Inner join of two feature sets, returns the joined set and the row numbers of the unmatched segments of both sets
+def joinFeatureSets(dftotal, df, suffix):
+    keys = joinKeys(dftotal, df)
+    left = dftotal.reset_index(drop=True)
+    right = df.reset_index(drop=True)
+    left['_left'] = np.arange(len(left))
+    right['_right'] = np.arange(len(right))
+
+    if 'start' in keys:
+        #Nearest start time within the same file, then check the end time as well
+        joined = pd.merge_asof(left.sort_values('start'), right.sort_values('start'), on='start', by='file_name', tolerance=timeTolerance, direction='nearest', suffixes=('', suffix))
+        joined = joined[joined['_right'].notna() & ((joined['end'] - joined['end'+suffix]).abs() <= timeTolerance)]
+        joined = joined.drop('end'+suffix, axis=1).drop_duplicates('_right')
+    else:
+        if 'occurrence' in keys:
+            group = ['file_name', 'word'] if 'word' in keys else ['file_name']
+            left['occurrence'] = left.groupby(group).cumcount()
+            right['occurrence'] = right.groupby(group).cumcount()
+        joined = pd.merge(left, right, on=keys, how='inner', suffixes=('', suffix))
+        joined = joined.drop('occurrence', axis=1)
+
+    joined = joined.sort_values('_left')
+    unmatchedLeft = np.setdiff1d(left['_left'], joined['_left'])
+    unmatchedRight = np.setdiff1d(right['_right'], joined['_right'].astype(int))
+    joined = joined.drop(['_left', '_right'], axis=1).reset_index(drop=True)
+    return joined, unmatchedLeft, unmatchedRight
+
+#Print how many segments of a feature set were not combined, and which ones if they are not the last segments of a file
+def reportUnmatched(df, unmatched, filename):
+    if len(unmatched) == 0:
+        return
+    df = df.reset_index(drop=True)
+    isUnmatched = np.zeros(len(df), dtype=bool)
+    isUnmatched[unmatched] = True
+
+    #openSMILE can drop the last segment(s) of a file, so unmatched segments at the end of a file are expected
+    segments = pd.DataFrame({'file_name': df['file_name'], 'fromEnd': df.groupby('file_name').cumcount(ascending=False), 'unmatched': isUnmatched})
+    segments = segments.sort_values(['file_name', 'fromEnd'])
+    trailing = segments.groupby('file_name')['unmatched'].cumprod().astype(bool).sort_index().to_numpy()
+
+    print(len(unmatched), " segments of ", filename, " have no match, ", np.count_nonzero(trailing), " of them at the end of a file.")
+    other = df[isUnmatched & ~trailing]
+    if len(other) > 0:
+        columns = [column for column in ['file_name', 'word', 'start', 'end'] if column in df.columns]
+        print("Unmatched segments in the middle of a file:")
+        print(other[columns].head(10).to_string())
 
 def combineFeatureSets(filenames, removeOutliers):
     dftotal = None
     for filename in filenames:
         print("\n"+filename)
-        df = pd.read_excel(filename)
+        df = read_table(filename)
         df.columns = list(df.columns)
         
         varname = 'name'
@@ -73,33 +143,17 @@ def combineFeatureSets(filenames, removeOutliers):
         
         if(dftotal is None):
             dftotal = df.copy()
+            totalname = filename
         else:        
-            newdfs = None
-            for name in dftotal['file_name'].unique():
-                subdf1 = df[df.file_name == name]
-                subdf2 = dftotal[dftotal.file_name == name]
-             
-                if(len(subdf1) != 0 and len(subdf2) != 0):
-                    #possible that the last few 'words' have to be deleted
-                    #cause of a problem with generating the eGeMAPS
-                    if(len(subdf1)>len(subdf2)): 
-                        subdf1 = subdf1.drop(subdf1.tail(len(subdf1)-len(subdf2)).index)   
-                    if(len(subdf2)>len(subdf1)): 
-                        subdf2 = subdf2.drop(subdf2.tail(len(subdf2)-len(subdf1)).index) 
-                        
-                print(len(subdf1), " en ", len(subdf2))
-                print(subdf1.head(5))
-                print("en")
-                print(subdf2.head(5))
-                print("-------------")
-                
-                #resetting indexes so the concatenation goes well 
-                subdf1.reset_index(drop=True, inplace=True)
-                subdf2.reset_index(drop=True, inplace=True)
-                newdf = pd.concat([subdf1, subdf2], axis=1)
-                newdfs = pd.concat([newdfs, newdf])
-
-            dftotal = newdfs
+            #Keyed join instead of matching the segments by position, so a segment that is missing
+            #in one of the sets (anywhere in the file) does not shift the other segments
+            #Columns that both sets have get the number of the set as suffix, e.g. class_2
+            joined, unmatchedLeft, unmatchedRight = joinFeatureSets(dftotal, df, "_"+str(filenames.index(filename)+1))
+            reportUnmatched(dftotal, unmatchedLeft, totalname)
+            reportUnmatched(df, unmatchedRight, filename)
+            dftotal = joined
+            print(len(dftotal), " segments combined.")
+            totalname = "the combined features"
             
     dftotal = dftotal.reset_index()
     
@@ -139,6 +193,8 @@ def combineFeatureSets(filenames, removeOutliers):
             
     return dftotal
     
-dftotal = combineFeatureSets(filenames, removeOutliers)
-dftotal.to_excel(output_name, index=False)
-print("The file "+ output_name + " is created.")
\ No newline at end of file
+#Only when run as a script, so combineFeatureSets can be imported (e.g. by benchmarks/run_benchmarks.py)
+if __name__ == "__main__":
+    dftotal = combineFeatureSets(filenames, removeOutliers)
+    write_table(dftotal, output_name, 'participant' if partitionByParticipant else None)
+    print("The file "+ output_name + " is created.")
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""
+Summary statistics of the segment features per recording, session and participant.
+
+The participant, test phase and session of every recording are parsed from
+its file name with a regular expression with named groups (see
+FILE_NAME_PATTERN, e.g. 10101_posttest0_11 is participant 10101, test phase
+posttest, session 0). The result files of a run over several tiers end in
+_tier<N>_results (see run_LabeledSegmentsAnalysis_v3.py); their tier is part
+of every group, so the tiers are summarized separately. Only the distinct file
+names are parsed. All statistics
+(mean, median, standard deviation, quantiles and the mean weighted by segment
+duration) of all features are then computed with one grouped pass over the
+segments per level, without a Python loop over the recordings.
+
+A summary table has one row per group, the group columns, the number of
+recordings, total_dur and total_intervals (the summed duration in ms and the
+number of the segments) and a column
+<feature>_<statistic> per feature and statistic, e.g. pitch_mean_median or
+f1_q25.
+"""
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from feature_tables import write_table
+from segment_tables import FEATURE_COLUMNS
+
+
+# participant_phasesession_item, e.g. 10101_posttest0_11. Groups that are not in a pattern are left empty
+FILE_NAME_PATTERN = r'(?P<participant>[^_]+)_(?P<phase>[^\W\d_]+)(?P<session>\d*)(?:_|$)'
+
+GROUP_COLUMNS = ['participant', 'phase', 'session']
+
+# The tier at the end of the result files of a run over several tiers, e.g. 10101_posttest0_11_tier2_results
+TIER_PATTERN = r'_tier(?P<tier>\d+)_results$'
+
+# The columns that identify a group at every level; tier is left out when no file name has one
+LEVELS = {'recording': ['participant', 'phase', 'session', 'tier', 'file_name'],
+          'session': ['participant', 'phase', 'session', 'tier'],
+          'participant': ['participant', 'tier']}
+
+STATISTICS = ['mean', 'median', 'std', 'wmean']
+
+DEFAULT_QUANTILES = [0.25, 0.75]
+
+
+def parse_file_names(file_names, pattern=FILE_NAME_PATTERN, participants=None):
+    """
+    The participant, phase, session and tier of every file name, as a
+    DataFrame. Every distinct file name is matched once. File names that do not
+    match the pattern keep the participant in `participants` (if given) and get
+    an empty phase and session; file names without a tier get an empty tier.
+    """
+    regex = re.compile(pattern)
+    unique, inverse = np.unique(np.asarray(file_names, dtype=str), return_inverse=True)
+    matches = [regex.match(name) for name in unique]
+    columns = {}
+    for column in GROUP_COLUMNS:
+        parsed = np.array([(match.groupdict().get(column) or '') if match else '' for match in matches], dtype=object)
+        columns[column] = parsed[inverse]
+    if participants is not None:
+        matched = np.array([match is not None and bool(match.groupdict().get('participant')) for match in matches])[inverse]
+        columns['participant'] = np.where(matched, columns['participant'], np.asarray(participants, dtype=object))
+    tier_regex = re.compile(TIER_PATTERN)
+    tiers = [tier_regex.search(name) for name in unique]
+    columns['tier'] = np.array([tier.group('tier') if tier else '' for tier in tiers], dtype=object)[inverse]
+    return pd.DataFrame(columns)
+
+
+def quantile_column(q):
+    return f'q{q * 100:g}'
+
+
+def group_statistics(values, codes, groups, weights=None, statistics=STATISTICS, quantiles=DEFAULT_QUANTILES):
+    """
+    Statistics of the columns of values (rows x features, NaN is a missing
+    value) per group, where codes is the group (0 .. groups-1) of every row.
+    wmean weights the rows with weights. Returns a dict of statistic name
+    (mean, median, std, wmean or a quantile column such as q25) to a
+    groups x features array; groups without values get NaN.
+    """
+    for name in statistics:
+        if name not in STATISTICS:
+            raise ValueError(f'Unknown statistic {name}, choose from {", ".join(STATISTICS)}')
+    values = np.asarray(values, dtype=float)
+    codes = np.asarray(codes, dtype=np.intp)
+    all_groups = pd.RangeIndex(groups)
+
+    # One groupby over all features; every statistic is a single vectorized (Cython) reduction over all groups
+    grouped = pd.DataFrame(values).groupby(codes, sort=True)
+    results = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name in statistics:
+            if name == 'wmean':
+                valid = ~np.isnan(values)
+                weighted = np.where(valid, values * np.asarray(weights, dtype=float)[:, None], 0.0)
+                totals = pd.DataFrame(np.hstack([weighted, valid * np.asarray(weights, dtype=float)[:, None]])).groupby(codes).sum()
+                totals = totals.reindex(all_groups).to_numpy()
+                results[name] = totals[:, :values.shape[1]] / totals[:, values.shape[1]:]
+            else:
+                results[name] = getattr(grouped, name)().reindex(all_groups).to_numpy()
+    for q in quantiles:
+        results[quantile_column(q)] = np.zeros((0, values.shape[1]))
+    if quantiles and len(values):
+        by_quantile = grouped.quantile(list(quantiles))
+        for q in quantiles:
+            results[quantile_column(q)] = by_quantile.xs(q, level=1).reindex(all_groups).to_numpy()
+    return results
+
+
+def group_codes(file_names, pattern=FILE_NAME_PATTERN, participants=None):
+    """
+    The group columns of every recording and the recording of every row. Only
+    the distinct recordings are parsed, so the text handling does not grow
+    with the number of segments.
+    """
+    rows, recordings = pd.factorize(np.asarray(file_names, dtype=object))
+    if participants is not None:
+        first_rows = np.unique(rows, return_index=True)[1]
+        participants = np.asarray(participants, dtype=object)[first_rows]
+    groups = parse_file_names(recordings, pattern, participants)
+    groups['file_name'] = np.asarray(recordings, dtype=object)
+    return groups, rows
+
+
+def aggregate(segments, level, pattern=FILE_NAME_PATTERN, statistics=STATISTICS, quantiles=DEFAULT_QUANTILES, features=FEATURE_COLUMNS):
+    """
+    Summary table of the segment rows in segments (a table of
+    organizing_PraatFeatures.py or run_pipeline.py) at `level` (recording,
+    session or participant).
+    """
+    if level not in LEVELS:
+        raise ValueError(f'Unknown level {level}, choose from {", ".join(LEVELS)}')
+    recordings, rows = group_codes(segments['file_name'], pattern, segments['participant'] if 'participant' in segments else None)
+
+    keys = [key for key in LEVELS[level] if key != 'tier' or recordings['tier'].any()]
+    recording_groups, uniques = pd.MultiIndex.from_frame(recordings[keys]).factorize(sort=True)
+    codes = recording_groups[rows]
+    number_of_groups = len(uniques)
+    features = [feature for feature in features if feature in segments]
+    durations = segments['dur'].to_numpy(dtype=float)
+    results = group_statistics(segments[features].to_numpy(dtype=float), codes, number_of_groups, durations, statistics, quantiles)
+
+    table = {key: uniques.get_level_values(i).to_numpy(dtype=object) for i, key in enumerate(keys)}
+    if level != 'recording':
+        table['recordings'] = np.bincount(recording_groups, minlength=number_of_groups)
+    table['total_dur'] = np.bincount(codes, weights=np.nan_to_num(durations), minlength=number_of_groups)
+    table['total_intervals'] = np.bincount(codes, minlength=number_of_groups)
+    for j, feature in enumerate(features):
+        for name, values in results.items():
+            table[f'{feature}_{name}'] = values[:, j]
+    return pd.DataFrame(table)
+
+
+def level_path(path, level):
+    # lsa-features-total.parquet -> lsa-features-total_participant.parquet
+    root, extension = os.path.splitext(path)
+    return f'{root}_{level}{extension}'
+
+
+def write_aggregates(segments, path, levels, pattern=FILE_NAME_PATTERN, statistics=STATISTICS, quantiles=DEFAULT_QUANTILES):
+    """Write the summary table of every level next to the segment table at path. Returns the written paths."""
+    written = []
+    for level in levels:
+        level_file = level_path(path, level)
+        write_table(aggregate(segments, level, pattern, statistics, quantiles), level_file)
+        written.append(level_file)
+    return written
@@ -0,0 +1,177 @@
+"""
+Persistent cache of decoded audio, shared by the Praat and openSMILE pipelines.
+
+Decoding the .mp3 files is a large fixed cost that is paid again on every run
+and by every feature pipeline. This cache decodes every audio file once to mono
+32-bit float samples. Entries are content-addressed (the SHA-1 of the original
+file), so renamed or copied recordings share an entry and changed recordings
+get a new one.
+
+Every entry is a plain WAV file (IEEE float, mono) with a fixed 44-byte header,
+so Praat and SMILExtract can read the cached file directly, and Python reads the
+samples memory-mapped. The cache has a size cap: when it is exceeded, the least
+recently used entries are removed. Reading an entry updates its modification
+time, which is used as the last access time.
+
+Hashing reads the whole original file, so the hashes are kept in an index
+(index.jsonl in the cache directory) keyed on the path, size and modification
+time of the original. A lookup of a file that was hashed before, by any run or
+process, only needs a stat.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from manifest import file_identity
+
+
+HEADER_SIZE = 44
+HASH_BLOCK_SIZE = 1 << 20
+INDEX_FILE = 'index.jsonl'
+
+
+def content_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def wav_header(number_of_samples, sampling_frequency):
+    data_size = 4 * number_of_samples
+    return (b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVE'
+            + b'fmt ' + struct.pack('<IHHIIHH', 16, 3, 1, int(sampling_frequency), 4 * int(sampling_frequency), 4, 32)
+            + b'data' + struct.pack('<I', data_size))
+
+
+def decode(audio_file):
+    """Decode an audio file with Praat and return its mono samples and sampling frequency."""
+    import parselmouth
+
+    sound = parselmouth.Sound(audio_file)
+    return sound.values.mean(axis=0).astype(np.float32), sound.sampling_frequency
+
+
+class HashIndex:
+    """Content hashes of files, kept in INDEX_FILE in `directory` (see the module docstring)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hashes = {}
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE)) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a crashed run can be incomplete
+                        continue
+                    self.hashes[entry['path']] = (entry['identity'], entry['hash'])
+        except FileNotFoundError:
+            pass
+
+    def content_hash(self, audio_file):
+        """SHA-1 of audio_file, from the index if the file did not change since it was hashed."""
+        path = os.path.abspath(audio_file)
+        identity = file_identity(path)
+        if self.hashes.get(path, (None,))[0] != identity:
+            # Other processes may have hashed it in the meantime
+            self._load_index()
+        if self.hashes.get(path, (None,))[0] == identity:
+            return self.hashes[path][1]
+
+        digest = content_hash(path)
+        self.hashes[path] = (identity, digest)
+        with open(os.path.join(self.directory, INDEX_FILE), 'a') as f:
+            f.write(json.dumps({'path': path, 'identity': identity, 'hash': digest}) + '\n')
+        return digest
+
+
+class AudioCache:
+    """Cache of decoded audio in `directory`, at most `max_bytes` large."""
+
+    def __init__(self, directory, max_bytes=50 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.index = HashIndex(directory)
+
+    def content_hash(self, audio_file):
+        return self.index.content_hash(audio_file)
+
+    def path(self, audio_file):
+        """Path of the cached WAV file of audio_file, decoding it first if it is not in the cache."""
+        cache_file = os.path.join(self.directory, self.content_hash(audio_file) + '.wav')
+        if os.path.exists(cache_file):
+            try:
+                os.utime(cache_file)
+                return cache_file
+            except FileNotFoundError:
+                # Evicted by another process in the meantime
+                pass
+
+        samples, sampling_frequency = decode(audio_file)
+        # Write to a temporary file first, so other workers never see a half-written entry
+        fd, temporary_file = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(wav_header(len(samples), sampling_frequency))
+            f.write(samples.tobytes())
+        os.chmod(temporary_file, 0o644)
+        os.replace(temporary_file, cache_file)
+        self.evict(keep=cache_file)
+        return cache_file
+
+    def samples(self, audio_file):
+        """Memory-mapped mono samples and the sampling frequency of audio_file."""
+        cache_file = self.path(audio_file)
+        with open(cache_file, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        sampling_frequency = struct.unpack('<I', header[24:28])[0]
+        number_of_samples = struct.unpack('<I', header[40:44])[0] // 4
+        samples = np.memmap(cache_file, dtype=np.float32, mode='r', offset=HEADER_SIZE, shape=(number_of_samples,))
+        return samples, sampling_frequency
+
+    def sound(self, audio_file):
+        """
+        The decoded audio_file as a parselmouth Sound. The float32 samples are
+        copied from the memory map straight into the Sound's own float64 buffer,
+        without a float64 copy in between. np.zeros only reserves zero pages, so
+        creating the Sound from it costs no extra memory either.
+        """
+        import parselmouth
+
+        samples, sampling_frequency = self.samples(audio_file)
+        sound = parselmouth.Sound(np.zeros((1, len(samples))), sampling_frequency)
+        sound.values[0] = samples
+        return sound
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache is smaller than max_bytes."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.wav'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
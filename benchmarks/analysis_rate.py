@@ -0,0 +1,115 @@
+"""
+Deviations of the features computed at a reduced analysis rate from the full-rate features.
+
+Every recording is analysed twice with the parselmouth engine
+(segment_analysis.analyze_segments): at the sampling frequency of the audio
+file, and resampled to --analysisRate (a frequency in Hz, or 'formant' for
+twice the maximum formant). For every feature this prints the median, 95th
+percentile and maximum of the relative deviation |reduced - full| / |full|
+over all segments, and the number of segments for which the feature is
+defined at one rate but not at the other (e.g. a pitch that is found at one
+rate only). Durations do not depend on the rate and are left out. The time of
+both analyses and the size of the analysed audio are printed as well.
+
+Without --audioDir, a synthetic corpus (see synthetic_corpus.py) at
+--samplingFrequency is generated and used.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_DIR)
+from segment_analysis import DEFAULT_SETTINGS, analysis_rate, analyze_segments, load_sound, resample_for_analysis
+from segment_tables import FEATURE_COLUMNS
+from synthetic_corpus import generate_corpus
+
+
+def analyze_corpus(recordings, tier_number, settings):
+    """The features of all segments of the recordings (a list of audio file and TextGrid) and the analysis time."""
+    start = time.perf_counter()
+    features = {column: [] for column in FEATURE_COLUMNS}
+    for audio_file, textgrid_file in recordings:
+        starts, ends, labels, recording_features = analyze_segments(audio_file, textgrid_file, [tier_number], settings=settings)[tier_number]
+        for column in FEATURE_COLUMNS:
+            features[column].append(recording_features[column])
+    return {column: np.concatenate(values) for column, values in features.items()}, time.perf_counter() - start
+
+
+def deviations(full, reduced):
+    """Per feature: the relative deviations of the segments where both are defined, and the number of segments defined at one rate only."""
+    report = {}
+    for column in FEATURE_COLUMNS[1:]:
+        defined = ~np.isnan(full[column]) & ~np.isnan(reduced[column])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = np.abs(reduced[column][defined] - full[column][defined]) / np.abs(full[column][defined])
+        relative = relative[np.isfinite(relative)]
+        report[column] = {'segments': int(defined.sum()),
+                          'median': float(np.median(relative)) if len(relative) else None,
+                          'p95': float(np.percentile(relative, 95)) if len(relative) else None,
+                          'max': float(np.max(relative)) if len(relative) else None,
+                          'defined_at_one_rate': int((np.isnan(full[column]) != np.isnan(reduced[column])).sum())}
+    return report
+
+
+def run(args):
+    rate = args.analysisRate if args.analysisRate == 'formant' else float(args.analysisRate)
+    settings = dict(DEFAULT_SETTINGS, analysis_rate=rate)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.audioDir is None:
+            generate_corpus(work_dir, args.files, args.segmentsPerFile, sampling_frequency=args.samplingFrequency)
+            audio_dir, textgrid_dir, audio_extension = os.path.join(work_dir, 'audio'), os.path.join(work_dir, 'textgrids'), '.wav'
+        else:
+            audio_dir, textgrid_dir, audio_extension = args.audioDir, args.textGridDir, args.audioExtension
+        textgrid_files = sorted(glob.glob(os.path.join(textgrid_dir, '*.TextGrid')))[:args.files if args.audioDir is None else None]
+        recordings = [(os.path.join(audio_dir, os.path.basename(textgrid_file)[:-len('.TextGrid')] + audio_extension), textgrid_file)
+                      for textgrid_file in textgrid_files]
+
+        full, full_seconds = analyze_corpus(recordings, args.tierNumber, DEFAULT_SETTINGS)
+        reduced, reduced_seconds = analyze_corpus(recordings, args.tierNumber, settings)
+        sound = load_sound(recordings[0][0])
+        full_rate, reduced_rate = sound.sampling_frequency, resample_for_analysis(sound, settings).sampling_frequency
+
+    report = {'recordings': len(recordings), 'segments': len(full['dur']), 'sampling_frequency': full_rate,
+              'analysis_rate': analysis_rate(settings), 'full_rate_seconds': full_seconds, 'analysis_rate_seconds': reduced_seconds,
+              'features': deviations(full, reduced)}
+
+    print(f'{len(recordings)} recordings, {report["segments"]} segments, analysed at {full_rate:.0f} Hz in {full_seconds:.2f} s '
+          f'and at {reduced_rate:.0f} Hz in {reduced_seconds:.2f} s ({full_seconds / reduced_seconds:.2f}x faster, '
+          f'{full_rate / reduced_rate:.2f}x less audio)\n')
+    print(f'{"feature":16s}{"segments":>9s}{"median":>10s}{"p95":>10s}{"max":>10s}{"one rate":>10s}')
+    for column, values in report['features'].items():
+        statistics = ''.join(f'{values[name]:10.2%}' if values[name] is not None else f'{"-":>10s}' for name in ['median', 'p95', 'max'])
+        print(f'{column:16s}{values["segments"]:9d}{statistics}{values["defined_at_one_rate"]:10d}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser("Message")
+    parser.add_argument("--analysisRate", type=str, default="16000", help = "Analysis rate in Hz, or 'formant' for twice the maximum formant")
+    parser.add_argument("--audioDir", type=str, default=None, help = "Path to audio directory, a synthetic corpus is used if not given")
+    parser.add_argument("--audioExtension", type=str, default=".wav", help = "Audio extension")
+    parser.add_argument("--textGridDir", type=str, default=None, help = "Dir to the TextGrids of the audio files")
+    parser.add_argument("--tierNumber", type=int, default=2, help = "Tier number of tier with segments that should be analysed")
+    parser.add_argument("--files", type=int, default=4, help = "Number of files of the synthetic corpus")
+    parser.add_argument("--segmentsPerFile", type=int, default=40, help = "Number of words per file of the synthetic corpus")
+    parser.add_argument("--samplingFrequency", type=float, default=44100, help = "Sampling frequency of the synthetic corpus")
+    parser.add_argument("--output", type=str, default=None, help = "Write the report to this JSON file")
+
+    parser.set_defaults(func=run)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Benchmarks of the feature pipeline on a synthetic corpus (see synthetic_corpus.py).
+
+For every corpus size, these stages are run and timed:
+
+    extraction_parselmouth  run_LabeledSegmentsAnalysis_v3.py --engine parselmouth
+    extraction_praat        run_LabeledSegmentsAnalysis_v3.py --engine praat (LabeledSegmentsAnalysis_v3.praat)
+    organize                organizing_PraatFeatures.py on the .txt results
+    combine                 combining_praat_gemaps.combineFeatureSets of the organized features and a
+                            synthetic openSMILE table with 88 features per word
+
+Every stage runs in its own process, so its wall time includes starting
+Python and its peak RSS is its own. The Praat script only looks for .mp3
+files, so the Praat engine reads the corpus through the decoded-audio cache,
+which is filled before the stage is timed.
+
+The results of both engines are compared with the ground truth of the corpus
+(F0, formants and durations of every word). The run fails (exit code 1) when
+an accuracy threshold is exceeded, or when the throughput (segments/s) of a
+stage is more than --tolerance below the stored baseline. Write a new baseline
+with --updateBaseline after an intended change, or on another machine.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_DIR)
+from audio_cache import AudioCache
+from organizing_PraatFeatures import organize
+from synthetic_corpus import generate_corpus
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+STAGES = ['extraction_parselmouth', 'extraction_praat', 'organize', 'combine']
+
+OPENSMILE_FEATURES = 88
+
+# Maximum median relative error of a result column against the ground truth column
+ACCURACY_THRESHOLDS = {('pitch_mean', 'f0'): 0.01, ('f0', 'F1'): 0.05, ('f1', 'F2'): 0.05, ('f2', 'F3'): 0.05}
+# Maximum error of the segment durations in ms (the Praat script writes them rounded to ms)
+DURATION_THRESHOLD = 1.0
+
+COMBINE_SCRIPT = '''
+import sys
+sys.path.insert(0, {gemaps_dir!r})
+import combining_praat_gemaps
+combining_praat_gemaps.combineFeatureSets({filenames!r}, True)
+'''
+
+
+def run_process(command, cwd):
+    """Run command, return its wall time and peak RSS (MB). Raises RuntimeError if it fails."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    # wait4 gives the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f'{" ".join(command)} failed:\n{stderr.decode(errors="replace")}')
+    peak_rss_mb = usage.ru_maxrss / 1024 ** 2 if sys.platform == 'darwin' else usage.ru_maxrss / 1024
+    return seconds, peak_rss_mb
+
+
+def opensmile_table(truth, path, seed=0):
+    """A table like the one of ExtractingFeatures_openSMILE.py, with random features for every word of the corpus."""
+    rng = np.random.default_rng(seed)
+    table = pd.DataFrame({'name': truth['file_name'], 'frameTime': truth['start'].astype(np.float32)})
+    features = rng.standard_normal((len(truth), OPENSMILE_FEATURES)).astype(np.float32)
+    table = pd.concat([table, pd.DataFrame(features, columns=[f'feature{i}' for i in range(OPENSMILE_FEATURES)])], axis=1)
+    table['word'] = truth['word'].to_numpy()
+    table['start'] = truth['start'].to_numpy()
+    table['end'] = truth['end'].to_numpy()
+    table['class'] = 'synthetic'
+    table.to_parquet(path, index=False)
+
+
+def check_accuracy(result_dir, truth):
+    """Median relative errors of the results in result_dir against the ground truth, and the maximum duration error."""
+    results = organize(result_dir, 'synthetic', False)
+    results = results.sort_values('file_name', kind='stable').reset_index(drop=True)
+    truth = truth.sort_values('file_name', kind='stable').reset_index(drop=True)
+    if len(results) != len(truth) or not (results['word'].to_numpy() == truth['word'].to_numpy()).all():
+        raise RuntimeError(f'The segments in {result_dir} do not match the words of the corpus')
+
+    errors = {}
+    for column, truth_column in ACCURACY_THRESHOLDS:
+        errors[f'{column}~{truth_column}'] = float(np.nanmedian(np.abs(results[column] - truth[truth_column]) / truth[truth_column]))
+    errors['dur'] = float(np.max(np.abs(results['dur'] - (truth['end'] - truth['start']) * 1000)))
+    return errors
+
+
+def accuracy_failures(errors):
+    failures = []
+    for (column, truth_column), threshold in ACCURACY_THRESHOLDS.items():
+        name = f'{column}~{truth_column}'
+        if errors[name] > threshold:
+            failures.append(f'{name} median relative error {errors[name]:.3f} > {threshold}')
+    if errors['dur'] > DURATION_THRESHOLD:
+        failures.append(f'dur error {errors["dur"]:.2f} ms > {DURATION_THRESHOLD} ms')
+    return failures
+
+
+def benchmark_size(files, segments_per_file, work_dir, stages):
+    """Generate a corpus of `files` recordings and run the stages on it. Returns the measurements and accuracies."""
+    corpus_dir = os.path.join(work_dir, 'corpus')
+    truth = generate_corpus(corpus_dir, files, segments_per_file)
+    audio_dir = os.path.join(corpus_dir, 'audio')
+    textgrid_dir = os.path.join(corpus_dir, 'textgrids')
+    cache_dir = os.path.join(work_dir, 'audio_cache')
+    audio_cache = AudioCache(cache_dir)
+    for audio_file in sorted(os.listdir(audio_dir)):
+        audio_cache.path(os.path.join(audio_dir, audio_file))
+
+    measurements = {}
+    accuracy = {}
+    for stage in stages:
+        if stage.startswith('extraction'):
+            engine = stage.split('_')[1]
+            result_dir = os.path.join(work_dir, engine)
+            command = [sys.executable, 'run_LabeledSegmentsAnalysis_v3.py', '--audioDir', audio_dir, '--audioExtension', '.wav',
+                       '--textGridDir', textgrid_dir, '--tierNumber', '2', '--lsaFeatureTxtDir', result_dir, '--engine', engine, '--force']
+            if engine == 'praat':
+                command += ['--audioCache', cache_dir]
+        elif stage == 'organize':
+            result_dir = os.path.join(work_dir, 'parselmouth' if 'extraction_parselmouth' in stages else 'praat')
+            command = [sys.executable, 'organizing_PraatFeatures.py', '--lsaFeatureTxtDir', result_dir,
+                       '--lsaFeatureTotalFile', os.path.join(work_dir, 'praat_features.parquet')]
+        else:
+            opensmile_table(truth, os.path.join(work_dir, 'opensmile_features.parquet'))
+            filenames = [os.path.join(work_dir, 'praat_features.parquet'), os.path.join(work_dir, 'opensmile_features.parquet')]
+            command = [sys.executable, '-c', COMBINE_SCRIPT.format(gemaps_dir=os.path.join(REPO_DIR, 'GeMAPS'), filenames=filenames)]
+
+        # The Praat engine runs ./LabeledSegmentsAnalysis_v3.praat
+        seconds, peak_rss_mb = run_process(command, REPO_DIR)
+        segments = len(truth)
+        measurements[stage] = {'files': files, 'segments': segments, 'seconds': seconds, 'files_per_second': files / seconds,
+                               'segments_per_second': segments / seconds, 'peak_rss_mb': peak_rss_mb}
+        if stage.startswith('extraction'):
+            accuracy[stage] = check_accuracy(result_dir, truth)
+    return measurements, accuracy
+
+
+def run(args):
+    sizes = [int(size) for size in args.sizes.split(',')]
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError(f'Unknown stage {stage}, choose from {", ".join(STAGES)}')
+    if ('organize' in stages or 'combine' in stages) and not any(stage.startswith('extraction') for stage in stages):
+        raise ValueError('organize and combine need the results of an extraction stage')
+    if 'combine' in stages and 'organize' not in stages:
+        raise ValueError('combine needs the results of the organize stage')
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['segments_per_second']
+
+    results = {'segments_per_second': {}, 'measurements': {}, 'accuracy': {}}
+    failures = []
+    print(f'{"stage":24s}{"files":>7s}{"segments":>10s}{"seconds":>9s}{"files/s":>9s}{"segm/s":>9s}{"peak MB":>9s}{"baseline":>10s}')
+    for files in sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            measurements, accuracy = benchmark_size(files, args.segmentsPerFile, work_dir, stages)
+
+        for stage, measurement in measurements.items():
+            key = f'{stage}/{files}x{args.segmentsPerFile}'
+            results['segments_per_second'][key] = measurement['segments_per_second']
+            results['measurements'][key] = measurement
+            reference = baseline.get(key)
+            status = ''
+            if reference is not None and measurement['segments_per_second'] < (1 - args.tolerance) * reference:
+                status = '  REGRESSION'
+                failures.append(f'{key}: {measurement["segments_per_second"]:.1f} segments/s, baseline {reference:.1f}')
+            print(f'{stage:24s}{files:7d}{measurement["segments"]:10d}{measurement["seconds"]:9.2f}{measurement["files_per_second"]:9.2f}'
+                  f'{measurement["segments_per_second"]:9.1f}{measurement["peak_rss_mb"]:9.0f}'
+                  f'{reference if reference is not None else float("nan"):10.1f}{status}')
+
+        for stage, errors in accuracy.items():
+            key = f'{stage}/{files}x{args.segmentsPerFile}'
+            results['accuracy'][key] = errors
+            failures += [f'{key}: {failure}' for failure in accuracy_failures(errors)]
+
+    print('\nMedian relative error against the ground truth (dur: maximum error in ms)')
+    for key, errors in results['accuracy'].items():
+        print(f'{key:40s}' + '  '.join(f'{name} {value:.4f}' for name, value in errors.items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.updateBaseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'segments_per_second': results['segments_per_second']}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'\nBaseline written to {args.baseline}')
+        return
+
+    if failures:
+        print('\nFAILED:\n' + '\n'.join(failures))
+        sys.exit(1)
+    print('\nAll benchmarks passed.')
+
+
+def main():
+    parser = argparse.ArgumentParser("Message")
+    parser.add_argument("--sizes", type=str, default="4,16", help = "Comma-separated corpus sizes (number of files)")
+    parser.add_argument("--segmentsPerFile", type=int, default=40, help = "Number of words per file")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES), help = "Comma-separated stages to run: " + ", ".join(STAGES))
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE, help = "JSON file with the baseline throughput (segments/s) per stage and size")
+    parser.add_argument("--tolerance", type=float, default=0.3, help = "Fail when the throughput is more than this fraction below the baseline")
+    parser.add_argument("--updateBaseline", action="store_true", help = "Write the measured throughput as the new baseline instead of comparing with it")
+    parser.add_argument("--output", type=str, default=None, help = "Write all measurements and accuracies to this JSON file")
+
+    parser.set_defaults(func=run)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Reproducible synthetic corpus with known ground truth.
+
+Every recording is a sequence of words separated by pauses. A word is a
+voiced vowel: a harmonic complex with a constant F0, whose harmonic
+amplitudes follow a cascade of formant resonances, plus a little noise.
+Pauses are low-level noise. Next to every .wav file, a TextGrid is written
+with the four tiers of the TextGrids made from WhisperTimestamped results
+(see uber.sh):
+
+    Tier 1: wordsDisTier   words and disfluencies ("eh")
+    Tier 2: wordsTier      words only
+    Tier 3: confTier       confidence of every word
+    Tier 4: segmentsTier   the words of an utterance
+
+ground_truth.tsv has one row per word of tier 2, with its start and end time,
+F0 and formant frequencies. The same seed always gives the same corpus.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import parselmouth
+
+
+SAMPLING_FREQUENCY = 16000
+
+# F1, F2, F3 (Hz) of the vowels of the words
+VOWELS = {'aap': (800, 1200, 2500), 'mies': (300, 2300, 3000), 'boek': (350, 800, 2400),
+          'fee': (500, 1900, 2600), 'boom': (500, 900, 2500)}
+# Higher formants, the same for all vowels (the analysis looks for 5 formants below 5500 Hz)
+HIGHER_FORMANTS = (3500, 4500)
+FORMANT_BANDWIDTHS = (80, 100, 150, 200, 250)
+DISFLUENCY = 'eh'
+DISFLUENCY_FORMANTS = (550, 1600, 2500)
+
+LEADING_SILENCE = 0.3
+NOISE_LEVEL = 0.001
+RAMP_DURATION = 0.01
+
+
+def harmonic_vowel(duration, f0, formants, rng, sampling_frequency=SAMPLING_FREQUENCY):
+    """A harmonic complex at f0 with the spectral envelope of the formants, with short onset and offset ramps."""
+    t = np.arange(int(round(duration * sampling_frequency))) / sampling_frequency
+    harmonics = np.arange(1, int(0.45 * sampling_frequency / f0) + 1) * f0
+    envelope = np.ones(len(harmonics))
+    for frequency, bandwidth in zip(formants + HIGHER_FORMANTS, FORMANT_BANDWIDTHS):
+        # Magnitude response of a cascade of second-order resonances
+        envelope /= np.sqrt((1 - (harmonics / frequency) ** 2) ** 2 + (harmonics * bandwidth / frequency ** 2) ** 2)
+    envelope /= harmonics / f0  # spectral tilt of the glottal source
+    phases = rng.uniform(0, 2 * np.pi, len(harmonics))
+    signal = (envelope[:, None] * np.sin(2 * np.pi * harmonics[:, None] * t + phases[:, None])).sum(axis=0)
+    signal *= 0.3 / np.max(np.abs(signal))
+
+    ramp = min(int(RAMP_DURATION * sampling_frequency), len(t) // 2)
+    window = np.ones(len(t))
+    window[:ramp] = 0.5 - 0.5 * np.cos(np.pi * np.arange(ramp) / ramp)
+    window[len(t) - ramp:] = window[:ramp][::-1]
+    # Without a noise floor the valleys between the harmonics are so deep that LPC finds spurious formants
+    return signal * window + NOISE_LEVEL * rng.standard_normal(len(t))
+
+
+def textgrid_text(duration, tiers):
+    """Long text format of a TextGrid with interval tiers; tiers is a list of (name, [(start, end, label), ...])."""
+    lines = ['File type = "ooTextFile"', 'Object class = "TextGrid"', '', 'xmin = 0', f'xmax = {duration!r}',
+             'tiers? <exists>', f'size = {len(tiers)}', 'item []:']
+    for number, (name, intervals) in enumerate(tiers, start=1):
+        lines += [f'    item [{number}]:', '        class = "IntervalTier"', f'        name = "{name}"',
+                  '        xmin = 0', f'        xmax = {duration!r}', f'        intervals: size = {len(intervals)}']
+        for index, (start, end, label) in enumerate(intervals, start=1):
+            lines += [f'        intervals [{index}]:', f'            xmin = {start!r}', f'            xmax = {end!r}',
+                      '            text = "{}"'.format(label.replace('"', '""'))]
+    return '\n'.join(lines) + '\n'
+
+
+def fill_gaps(intervals, duration):
+    """Add empty intervals between the given intervals, so they cover 0 to duration."""
+    filled = []
+    time = 0.0
+    for start, end, label in intervals:
+        if start > time:
+            filled.append((time, start, ''))
+        filled.append((start, end, label))
+        time = end
+    if time < duration:
+        filled.append((time, duration, ''))
+    return filled
+
+
+def generate_recording(name, directory, segments, rng, word_duration=(0.2, 0.6), pause_duration=(0.05, 0.3),
+                       disfluency_rate=0.1, utterance_length=8, sampling_frequency=SAMPLING_FREQUENCY):
+    """Write name.wav and name.TextGrid for a recording with `segments` words, return its ground truth rows."""
+    parts = [NOISE_LEVEL * rng.standard_normal(int(LEADING_SILENCE * sampling_frequency))]
+    time = LEADING_SILENCE
+    words, disfluent_words, confidences, utterances, truth = [], [], [], [], []
+    utterance = []
+
+    def add(signal):
+        nonlocal time
+        parts.append(signal)
+        start = time
+        time += len(signal) / sampling_frequency
+        return start, time
+
+    for i in range(segments):
+        if rng.uniform() < disfluency_rate:
+            start, end = add(harmonic_vowel(rng.uniform(*word_duration), rng.uniform(90, 130), DISFLUENCY_FORMANTS, rng, sampling_frequency))
+            disfluent_words.append((start, end, DISFLUENCY))
+            add(NOISE_LEVEL * rng.standard_normal(int(rng.uniform(*pause_duration) * sampling_frequency)))
+
+        word = list(VOWELS)[rng.integers(len(VOWELS))]
+        f0 = rng.uniform(100, 250)
+        start, end = add(harmonic_vowel(rng.uniform(*word_duration), f0, VOWELS[word], rng, sampling_frequency))
+        words.append((start, end, word))
+        disfluent_words.append((start, end, word))
+        confidences.append((start, end, f'{rng.uniform(0.5, 1):.2f}'))
+        utterance.append((start, end, word))
+        truth.append({'file_name': name, 'word': word, 'start': start, 'end': end, 'f0': f0,
+                      'F1': VOWELS[word][0], 'F2': VOWELS[word][1], 'F3': VOWELS[word][2]})
+        if len(utterance) == utterance_length or i == segments - 1:
+            utterances.append((utterance[0][0], utterance[-1][1], ' '.join(label for _, _, label in utterance)))
+            utterance = []
+
+        add(NOISE_LEVEL * rng.standard_normal(int(rng.uniform(*pause_duration) * sampling_frequency)))
+    add(NOISE_LEVEL * rng.standard_normal(int(LEADING_SILENCE * sampling_frequency)))
+
+    duration = time
+    samples = np.concatenate(parts)
+    parselmouth.Sound(samples, sampling_frequency).save(os.path.join(directory, 'audio', name + '.wav'), 'WAV')
+    tiers = [('wordsDisTier', fill_gaps(disfluent_words, duration)), ('wordsTier', fill_gaps(words, duration)),
+             ('confTier', fill_gaps(confidences, duration)), ('segmentsTier', fill_gaps(utterances, duration))]
+    with open(os.path.join(directory, 'textgrids', name + '.TextGrid'), 'w') as f:
+        f.write(textgrid_text(duration, tiers))
+    return truth
+
+
+def generate_corpus(directory, files, segments_per_file, seed=0, **options):
+    """
+    Write a corpus of `files` recordings with `segments_per_file` words each to
+    directory/audio and directory/textgrids, and its ground truth to
+    directory/ground_truth.tsv. Returns the ground truth as a DataFrame.
+    """
+    os.makedirs(os.path.join(directory, 'audio'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'textgrids'), exist_ok=True)
+    rng = np.random.default_rng(seed)
+    truth = []
+    for i in range(files):
+        truth += generate_recording(f'spk{i:04d}_synthetic_{seed}', directory, segments_per_file, rng, **options)
+    truth = pd.DataFrame(truth)
+    truth.to_csv(os.path.join(directory, 'ground_truth.tsv'), sep='\t', index=False)
+    return truth
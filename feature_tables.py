@@ -0,0 +1,126 @@
+"""
+Reading and writing feature tables.
+
+The organized Praat features (organizing_PraatFeatures.py), the openSMILE
+features (GeMAPS/ExtractingFeatures_openSMILE.py) and the combined features
+(GeMAPS/combining_praat_gemaps.py) are written with write_table and read with
+read_table. The format follows the extension of the path:
+
+- .parquet and .feather: columnar and fast, without a row limit (need pyarrow)
+- .xlsx and .tsv: to export a table to Excel or other tools
+
+A Parquet table can be partitioned by participant. The path is then a
+directory with a subdirectory participant=<name> per participant, and
+read_table can read the rows of a few participants without reading the rest.
+
+TableWriter writes a .parquet, .feather or .tsv table in blocks of rows, so a
+table can be written while the rows are computed (see run_pipeline.py).
+"""
+
+import os
+import shutil
+
+import pandas as pd
+
+
+TABLE_FORMATS = ['.parquet', '.feather', '.xlsx', '.tsv']
+
+
+def table_format(path):
+    extension = os.path.splitext(os.path.normpath(path))[1].lower()
+    if extension not in TABLE_FORMATS:
+        raise ValueError(f'Unknown table format: {path} (use one of {", ".join(TABLE_FORMATS)})')
+    return extension
+
+
+def write_table(df, path, partition_by=None):
+    """Write df to path, partitioned on the column partition_by (Parquet only) if it is given."""
+    extension = table_format(path)
+    if partition_by is not None and extension != '.parquet':
+        raise ValueError(f'Only Parquet tables can be partitioned: {path}')
+
+    if extension == '.parquet':
+        if partition_by is not None:
+            # A partitioned table is a directory, writing adds files to it, so remove the old table first
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            df.to_parquet(path, index=False, partition_cols=[partition_by])
+        else:
+            df.to_parquet(path, index=False)
+    elif extension == '.feather':
+        df.reset_index(drop=True).to_feather(path)
+    elif extension == '.xlsx':
+        df.to_excel(path, index=False)
+    else:
+        df.to_csv(path, sep='\t', index=False)
+
+
+def read_table(path, participants=None):
+    """
+    Read a table written by write_table. With a list of participants, only the
+    rows of these participants are returned (for a Parquet table partitioned by
+    participant, only their partitions are read).
+    """
+    extension = table_format(path)
+    if extension == '.parquet':
+        filters = [('participant', 'in', list(participants))] if participants is not None else None
+        df = pd.read_parquet(path, filters=filters)
+        if os.path.isdir(path):
+            # Partition columns are read back as categories and put last
+            for column in df.select_dtypes('category').columns:
+                df[column] = df[column].astype(str)
+        return df
+
+    if extension == '.feather':
+        df = pd.read_feather(path)
+    elif extension == '.xlsx':
+        df = pd.read_excel(path)
+    else:
+        df = pd.read_csv(path, sep='\t')
+    if participants is not None:
+        df = df[df['participant'].isin(participants)].reset_index(drop=True)
+    return df
+
+
+class TableWriter:
+    """
+    Write a table to path block by block, without keeping it in memory. The
+    first block sets the columns and their types.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.extension = table_format(path)
+        if self.extension == '.xlsx':
+            raise ValueError(f'An .xlsx table cannot be written block by block, use .parquet, .feather or .tsv: {path}')
+        self.writer = None
+        self.schema = None
+        self.rows = 0
+
+    def write(self, df):
+        if self.extension == '.tsv':
+            df.to_csv(self.path, sep='\t', index=False, mode='a' if self.rows else 'w', header=not self.rows)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            if self.writer is None:
+                self.schema = table.schema
+                if self.extension == '.parquet':
+                    self.writer = pq.ParquetWriter(self.path, self.schema)
+                else:
+                    self.writer = pa.ipc.new_file(self.path, self.schema)
+            self.writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,57 @@
+"""
+Run manifest for incremental and resumable extraction.
+
+For every recording that was analysed successfully, one line is appended to
+the manifest with a key that combines the size and modification time of the
+audio file and the TextGrid with the analysis settings. A recording only has
+to be analysed again when its key changed, so re-runs after adding a few
+participants only analyse the new recordings, and a crashed run resumes where
+it stopped. Because lines are only appended, a crash can never corrupt the
+entries that were already written.
+"""
+
+import hashlib
+import json
+import os
+
+
+def manifest_path(output_dir):
+    # The manifest is written next to the output directory, not inside it
+    output_dir = os.path.normpath(output_dir)
+    return output_dir + '.manifest.jsonl'
+
+
+def file_identity(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def recording_key(audio_file, textgrid_file, options):
+    """
+    Key of one analysis: the identity of both input files plus the analysis
+    options (engine, tier number, labels and the Praat settings).
+    Raises OSError if one of the files does not exist.
+    """
+    content = [file_identity(audio_file), file_identity(textgrid_file), options]
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_manifest(path):
+    """Return a dict from recording name to key, later lines override earlier ones."""
+    manifest = {}
+    if not os.path.exists(path):
+        return manifest
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line of a crashed run can be incomplete
+                continue
+            manifest[entry['recording']] = entry['key']
+    return manifest
+
+
+def append_manifest(path, recording, key):
+    with open(path, 'a') as f:
+        f.write(json.dumps({'recording': recording, 'key': key}) + '\n')
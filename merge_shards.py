@@ -0,0 +1,67 @@
+"""
+This script combines the shards of a run with --shard i/N (see sharding.py)
+after checking that every recording was processed by exactly one shard.
+
+Praat features (run_LabeledSegmentsAnalysis_v3.py): the result files of the
+shard directories <lsaFeatureTxtDir>.shard-i-of-N are moved into
+lsaFeatureTxtDir and their manifests are merged. The recordings are the
+TextGrids in textGridDir.
+
+openSMILE features (GeMAPS/ExtractingFeatures_openSMILE.py): the shard tables
+<table>.shard-i-of-N.<extension> are concatenated into the table. The
+recordings are the files in audioDir.
+
+Nothing is combined when a recording is in several shards, or when
+recordings are missing (e.g. because they failed or a shard did not finish),
+unless --allowMissing is given.
+"""
+
+
+import os
+import glob
+import argparse
+import sys
+
+from sharding import merge_result_dirs, merge_tables
+
+
+def run(args):
+    if (args.lsaFeatureTxtDir is None) == (args.tableFile is None):
+        raise ValueError('Give either --lsaFeatureTxtDir (with --textGridDir) or --tableFile (with --audioDir)')
+
+    try:
+        if args.lsaFeatureTxtDir is not None:
+            tg_extension = '.TextGrid'
+            expected = [os.path.basename(textgrid_file)[:-len(tg_extension)]
+                        for textgrid_file in glob.glob(os.path.join(args.textGridDir, '*' + tg_extension))]
+            missing = merge_result_dirs(args.lsaFeatureTxtDir, args.shards, expected, args.allowMissing)
+            output = args.lsaFeatureTxtDir
+        else:
+            # The recording names of ExtractingFeatures_openSMILE.py: the audio file name without its extension
+            expected = [filename[0:-4] for filename in os.listdir(args.audioDir)]
+            missing = merge_tables(args.tableFile, args.shards, expected, allow_missing=args.allowMissing)
+            output = args.tableFile
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    if missing:
+        print(f'{len(missing)} recordings are missing: {", ".join(missing)}')
+    print(f'The {args.shards} shards are combined in {output} ({len(expected) - len(missing)} of {len(expected)} recordings).')
+
+
+def main():
+    parser = argparse.ArgumentParser("Message")
+    parser.add_argument("--shards", type=int, help = "Number of shards N of the run (--shard i/N)")
+    parser.add_argument("--lsaFeatureTxtDir", type=str, default=None, help = "Output dir of run_LabeledSegmentsAnalysis_v3.py")
+    parser.add_argument("--textGridDir", type=str, default=None, help = "Dir to the TextGrids of the run")
+    parser.add_argument("--tableFile", type=str, default=None, help = "Table of ExtractingFeatures_openSMILE.py (outdir + featureset_tierlevel_typeOfSpeech + tableextension)")
+    parser.add_argument("--audioDir", type=str, default=None, help = "Audio dir (indir) of ExtractingFeatures_openSMILE.py")
+    parser.add_argument("--allowMissing", action="store_true", help = "Combine the shards even if recordings are missing")
+
+    parser.set_defaults(func=run)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
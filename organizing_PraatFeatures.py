@@ -6,11 +6,12 @@ extracted from LabeledSegementAnalysis.praat
 Based on outlierDetection.py by Wieke Harmsen and extract_results.py by Maarten Vos
 
 Input: folders with .txt files containing Praat features
-Output: excel file with Praat features per segment
+Output: table with Praat features per segment (.parquet, .feather, .xlsx or .tsv, see feature_tables.py)
 
 Things to change depending on your data:
 resultsdir, dirforoutput,typeOfSpeech, featureset, calculate_mean.
-Possibly add string logic to extract correct participant from datanames on line 170
+Possibly add string logic to extract correct participant from datanames in participant_from_filename,
+or give --fileNamePattern for the summaries of --aggregate (see aggregation.py)
 
 @author: Loes van Bemmel
 @date created: 20-4-2021
@@ -25,72 +26,51 @@ import re
 import argparse
 import glob
 
-def compute_average(df_list_clean, dataframe_info):       
-    mean_columns = ['file_name', 'total_dur','total_intervals','dur_mean', 
-               'pitch_min_mean', 'pitch_max_mean', 'pitch_mean_mean',
-               'pitch_std_mean', 'pitch_var_mean', 'intensity_min_mean', 
-               'intensity_max_mean','intensity_mean_mean', 'intensity_std_mean', 
-               'f0_mean', 'f1_mean', 'f2_mean','f3_mean', 'grav_center_mean']
+from aggregation import FILE_NAME_PATTERN, LEVELS, STATISTICS, parse_file_names, write_aggregates
+from feature_tables import write_table
+from segment_tables import read_segment_table
     
-    means_matrix = []
-    for df_idx in range(len(df_list_clean)):
+SEGMENT_COLUMNS = ['word', 'dur', 'pitch_min', 'pitch_max', 'pitch_mean', 'pitch_std','pitch_var', 'intensity_min', 'intensity_max',
+                   'intensity_mean', 'intensity_std', 'f0', 'f1', 'f2','f3','grav_center']
         
-        #select one dataframe
-        df = df_list_clean[df_idx]
+MEAN_COLUMNS = ['file_name', 'total_dur','total_intervals','dur_mean', 
+                'pitch_min_mean', 'pitch_max_mean', 'pitch_mean_mean',
+                'pitch_std_mean', 'pitch_var_mean', 'intensity_min_mean', 
+                'intensity_max_mean','intensity_mean_mean', 'intensity_std_mean', 
+                'f0_mean', 'f1_mean', 'f2_mean','f3_mean', 'grav_center_mean']
         
-        #obtain the mean of all acoustic measures in this dataframe.
-        file_name = dataframe_info[df_idx][0]
-        total_dur = dataframe_info[df_idx][1]
-        total_intervals = dataframe_info[df_idx][2]
-        dur_mean = df["dur"].mean()
-        pitch_min_mean = df['pitch_min'].mean()
-        pitch_max_mean = df['pitch_max'].mean()
-        pitch_mean_mean = df['pitch_mean'].mean()
-        pitch_std_mean = df['pitch_std'].mean()
-        pitch_var_mean = df['pitch_var'].mean()
-        intensity_min_mean = df['intensity_min'].mean()
-        intensity_max_mean = df['intensity_max'].mean()
-        intensity_mean_mean = df['intensity_mean'].mean()
-        intensity_std_mean = df['intensity_std'].mean()
-        f0_mean = df['f0'].mean()
-        f1_mean = df['f1'].mean()
-        f2_mean = df['f2'].mean()
-        f3_mean = df['f3'].mean()
-        grav_center_mean = df['grav_center'].mean()
+#Positions of the features in the 21 tokens per segment written by the Praat script (the others are labels)
+FEATURE_INDICES = [1,3,4,5,6,8,10,11,12,13,15,16,17,18,20]
         
-        #Save all means in a list
-        row = [file_name, total_dur, total_intervals, dur_mean, pitch_min_mean, 
-               pitch_max_mean, pitch_mean_mean, pitch_std_mean, pitch_var_mean,
-               intensity_min_mean, intensity_max_mean, intensity_mean_mean,
-               intensity_std_mean, f0_mean, f1_mean, f2_mean, f3_mean, grav_center_mean]
         
-        #Append this list to another list (matrix)
-        means_matrix.append(row)
+def compute_average(segments, starts, dataframe_info):
+    """
+    Mean of every acoustic measure per recording.
+    segments is the DataFrame with the segments of all recordings, the segments
+    of recording i are the rows starts[i]:starts[i+1].
+    """
+    columns = {'file_name': [info[0] for info in dataframe_info],
+               'total_dur': [info[1] for info in dataframe_info],
+               'total_intervals': [info[2] for info in dataframe_info]}
+
+    for column in SEGMENT_COLUMNS[1:]:
+        values = segments[column].to_numpy(dtype=float)
+        #np.nanmean on the contiguous slice gives exactly the same value as pandas' Series.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            columns[column + '_mean'] = [np.nansum(values[starts[i]:starts[i+1]]) / np.count_nonzero(~np.isnan(values[starts[i]:starts[i+1]]))
+                                         for i in range(len(dataframe_info))]
     
     #Save the matrix as dataframe and return it
-    df_means = pd.DataFrame(means_matrix, columns = mean_columns)
-    
-    return df_means
-    
-def fill_matrix(line_array):
-    matrix = []
-    for element in line_array:
-        row = []
-        row.append(element[0])
-        
-        for idx in [1,3,4,5,6,8,10,11,12,13,15,16,17,18,20]:
-            try:
-                row.append(float(element[idx])) 
-            except ValueError:
-                row.append(np.nan) 
-        matrix.append(row)
-    return matrix   
+    return pd.DataFrame(columns, columns = MEAN_COLUMNS)
     
     
-def convert_txt_to_dataframes(lines):
-    dataframe_list = []
+def parse_txt_result(lines):
+    """
+    Split the lines of one result .txt file written by the Praat script.
+    Returns a (segments x 21) array of tokens and the info [file name, total duration, total intervals] per recording.
+    """
+    token_blocks = []
     dataframe_info = []
-    #Convert txt file to separate dataframe for every audio+TextGrid file
     
     indx = 2
     if(len(lines) == 2):
@@ -100,83 +80,129 @@ def convert_txt_to_dataframes(lines):
         # Split the line into an easy to use list
         if "\x00" in line:
             line = line.replace("\x00", "") #encoding issue, this is a workaround 
-        line = re.sub("\s\s+", " ", line) #replace any amount of spaces with a single space
+        line = re.sub(r"\s\s+", " ", line) #replace any amount of spaces with a single space
 
         line_list = line.split(" ")
 
-        info = []
         name_file = line_list[0]
-        info.append(name_file)
-        
         tot_dur = int(line_list[-1].replace("\n",""))
-        info.append(tot_dur)
-        
         tot_int = int(line_list[-3])
-        info.append(tot_int)
+        dataframe_info.append([name_file, tot_dur, tot_int])
         
-        dataframe_info.append(info)
-        
-        #Take repetitive part of line_list
+        #Take repetitive part of line_list and reshape it, such that each word is a separate row
         line_list = line_list[1:-4]
+        nr_rows = int(len(line_list)/21) 
+        token_blocks.append(np.asarray(line_list, dtype=str).reshape((nr_rows,21)))
         
-        #Reshape list to list in list, such that each word is separate sublist
-        length = len(line_list)
-        nr_rows = int(length/21) 
-        line_array = np.asarray(line_list)
-        line_array = line_array.reshape((nr_rows,21))
-
-        matrix = fill_matrix(line_array)
-        columns = ['word', 'dur', 'pitch_min', 'pitch_max', 'pitch_mean', 'pitch_std','pitch_var', 'intensity_min', 'intensity_max',
-                                   'intensity_mean', 'intensity_std', 'f0', 'f1', 'f2','f3','grav_center']
+    return token_blocks, dataframe_info
         
-        df = pd.DataFrame(matrix,columns=columns)
-        dataframe_list.append(df)
         
-    return dataframe_list, dataframe_info
-    
-def organize(directory, typeOfSpeech, calculate_mean):
-    dffinal = None
+def convert_tokens_to_dataframe(tokens):
+    #Convert all segments at once, values that are not numbers (--undefined--) become NaN
+    columns = {'word': tokens[:, 0]}
+    for column, idx in zip(SEGMENT_COLUMNS[1:], FEATURE_INDICES):
+        columns[column] = pd.to_numeric(tokens[:, idx], errors='coerce').astype(float)
+    return pd.DataFrame(columns, columns=SEGMENT_COLUMNS)
+        
 
+def convert_table_to_dataframe(filename):
+    #Segment tables (.npz/.parquet) already have typed columns, no text parsing needed
+    df = read_segment_table(filename)
+    info = [df['file_name'].iloc[0] if len(df) else os.path.basename(filename), int(round(df['dur'].sum())), len(df)]
+    df = df.drop(['file_name', 'segment'], axis=1)
+    return df, info
+        
+        
+def participant_from_filename(filename):
+    #Add your own files' participants strings if needed
+    #these should work for COPD, ISLA, and CHASING data 
+    #if none of them match, take the filename as participant 
+    if(filename.split('_')[0][0:10] == "Participant"):
+        return filename.split('_')[0]
+    elif(filename.split('_')[0][0:2] == "PP"):
+        return filename.split('_')[0]
+    elif(filename.split('_')[0][0:3] == "nds"):
+        return filename.split('_')[0]
+    elif(filename.split('_')[0][0:2] == "s0"):
+        return filename.split('_')[0]
+    return "".join(filename.split('_')[0:-2]) #don't include "_tierx_results.txt" in the participants name
+
+    
+def organize(directory, typeOfSpeech, calculate_mean, with_segments=False):
+    """
+    Table of all result files in directory: the segment rows, or with
+    calculate_mean the means per recording. With with_segments, the segment
+    rows are returned as well (as the second value, None without segments).
+    """
     txt_result_files = glob.glob(os.path.join(directory, '*.txt'))
+    table_result_files = glob.glob(os.path.join(directory, '*.npz')) + glob.glob(os.path.join(directory, '*.parquet'))
+    result_files = txt_result_files + table_result_files
 
-    for filename in txt_result_files:
-        dataset = open(os.path.join(directory,filename))
+    #Single pass over all result files: every recording becomes a block of segment rows
+    blocks = []
+    dataframe_info = []
+    recording_file = []
+    token_blocks = []
+    for file_idx, filename in enumerate(result_files):
+        if filename in table_result_files:
+            df, info = convert_table_to_dataframe(filename)
+            blocks.append(df)
+            dataframe_info.append(info)
+            recording_file.append(file_idx)
+            continue
 
         with open(filename, errors='ignore') as f:
-            lines = f.readlines()
-            dataframe_list, dataframe_info = convert_txt_to_dataframes(lines)
+            file_tokens, file_info = parse_txt_result(f.readlines())
+        token_blocks.extend(file_tokens)
+        blocks.extend([None] * len(file_tokens))
+        dataframe_info.extend(file_info)
+        recording_file.extend([file_idx] * len(file_tokens))
             
+    #The segments of all .txt result files are converted to numbers in one go
+    sizes = [len(block) for block in token_blocks]
+    if token_blocks:
+        txt_segments = convert_tokens_to_dataframe(np.concatenate(token_blocks))
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        txt_blocks = iter(txt_segments.iloc[offsets[i]:offsets[i+1]].reset_index(drop=True) for i in range(len(token_blocks)))
+        blocks = [next(txt_blocks) if block is None else block for block in blocks]
+
+    #All segment rows, in the order of the result files
+    sizes = [len(block) for block in blocks]
+    segments = pd.concat(blocks, ignore_index=True) if blocks else None
+    segment_files = np.repeat(recording_file, sizes)
+
+    file_names = [os.path.splitext(os.path.basename(filename))[0] for filename in result_files] #without the .txt
+    participants = [participant_from_filename(filename) for filename in result_files]
 
-        for df_idx in range(len(dataframe_list)):
-                #Select dataframe & corresponding dataframe info
-                df = dataframe_list[df_idx]
-                df_info = dataframe_info[df_idx]
-                
-                #Compute average of every acoustic measure
-                if(calculate_mean):
-                    df_mean = compute_average(dataframe_list, dataframe_info) 
-                    df = df_mean
-                    
-                df['class'] = typeOfSpeech
-                    
-                #Add your own files' participants strings if needed
-                #these should work for COPD, ISLA, and CHASING data 
-                #if none of them match, take the filename as participant 
-                if(filename.split('_')[0][0:10] == "Participant"):
-                    df['participant'] = filename.split('_')[0]
-                elif(filename.split('_')[0][0:2] == "PP"):
-                    df['participant'] = filename.split('_')[0]
-                elif(filename.split('_')[0][0:3] == "nds"):
-                    df['participant'] = filename.split('_')[0]
-                elif(filename.split('_')[0][0:2] == "s0"):
-                    df['participant'] = filename.split('_')[0]
-                else:
-                    df['participant'] = "".join(filename.split('_')[0:-2]) #don't include "_tierx_results.txt" in the participants name
-                
-                    
-                df['file_name'] = os.path.basename(filename).replace('.txt', '') #filename[0:-4] #without the .txt
-                dffinal = pd.concat([dffinal, df]) 
-    return dffinal
+    def add_recording_columns(df, row_files):
+        df['class'] = typeOfSpeech
+        df['participant'] = [participants[file_idx] for file_idx in row_files]
+        df['file_name'] = [file_names[file_idx] for file_idx in row_files]
+
+    if(calculate_mean):
+        #The means are computed once per recording. Like before, the means of all recordings in a result file are
+        #added for every recording in that file.
+        starts = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+        df_means = compute_average(segments if segments is not None else pd.DataFrame(columns=SEGMENT_COLUMNS), starts, dataframe_info)
+        counts = np.bincount(np.asarray(recording_file, dtype=int), minlength=len(result_files))
+        firsts = np.concatenate([[0], np.cumsum(counts)])
+        rows = []
+        for file_idx in range(len(result_files)):
+            rows.extend(np.tile(np.arange(firsts[file_idx], firsts[file_idx+1]), counts[file_idx]))
+        final = df_means.iloc[rows].reset_index(drop=True)
+        add_recording_columns(final, [recording_file[row] for row in rows])
+
+    if segments is not None and (with_segments or not calculate_mean):
+        add_recording_columns(segments, segment_files)
+        #Same column order as adding the columns to every recording before concatenating them
+        column_order = dict.fromkeys(column for block in blocks for column in list(block.columns) + ['class', 'participant', 'file_name'])
+        segments = segments[list(column_order)]
+
+    if not calculate_mean:
+        final = segments
+    if with_segments:
+        return final, segments
+    return final
     
 
 
@@ -188,14 +214,33 @@ def run(args):
 
     calculate_mean = args.calculateMean #if True, only the mean values per recording will be saved
 
-    resultdf = organize(lsaFeatureTxtDir, typeOfSpeech, calculate_mean)
+    #The segment rows are only kept for the summaries
+    if args.aggregate:
+        resultdf, segments = organize(lsaFeatureTxtDir, typeOfSpeech, calculate_mean, with_segments=True)
+    else:
+        resultdf = organize(lsaFeatureTxtDir, typeOfSpeech, calculate_mean)
     
     mean = ""
     if(calculate_mean):
         mean = "_mean"
 
-    resultdf.to_csv(lsaFeatureTotalFile, index=False, sep='\t')
+    partition_by = None
+    if args.partitionByParticipant:
+        #The participant column is derived from the full path of the result files, so the partitions get the
+        #participant of the file name instead (as in run_pipeline.py)
+        partition_by = 'participant'
+        names, inverse = np.unique(resultdf['file_name'].astype(str), return_inverse=True)
+        parsed = parse_file_names(names, args.fileNamePattern, [participant_from_filename(name) for name in names])
+        resultdf = resultdf.assign(participant=parsed['participant'].values[inverse])
+    write_table(resultdf, lsaFeatureTotalFile, partition_by)
     print("The file "+ os.path.basename(lsaFeatureTotalFile) + " is created.")
+
+    if args.aggregate and segments is not None:
+        #All summary levels from the segments, in one pass per level
+        levels = args.aggregate.split(',')
+        quantiles = [float(q) for q in args.quantiles.split(',') if q]
+        for level_file in write_aggregates(segments, lsaFeatureTotalFile, levels, args.fileNamePattern, args.statistics.split(','), quantiles):
+            print("The file "+ os.path.basename(level_file) + " is created.")
     
 
 def main():
@@ -203,6 +248,11 @@ def main():
     parser.add_argument("--lsaFeatureTxtDir", type=str, help = "Path to fluency-features-dir directory.")
     parser.add_argument("--lsaFeatureTotalFile", type=str, help = "Path to fluency-features-dir directory.")
     parser.add_argument("--calculateMean", type=str, help = "Calculate only mean values.")
+    parser.add_argument("--partitionByParticipant", action="store_true", help = "Write a .parquet lsaFeatureTotalFile as a directory with one partition per participant.")
+    parser.add_argument("--aggregate", type=str, default=None, help = "Comma-separated summary levels (" + ", ".join(LEVELS) + "), each written to lsaFeatureTotalFile with _<level> added to the name")
+    parser.add_argument("--fileNamePattern", type=str, default=FILE_NAME_PATTERN, help = "Regular expression with the named groups participant, phase and session, matched at the start of every file name")
+    parser.add_argument("--statistics", type=str, default=",".join(STATISTICS), help = "Comma-separated statistics of the summaries: " + ", ".join(STATISTICS) + " (mean weighted by segment duration)")
+    parser.add_argument("--quantiles", type=str, default="0.25,0.75", help = "Comma-separated quantiles of the summaries (empty for none)")
 
     parser.set_defaults(func=run)
     args = parser.parse_args()
@@ -0,0 +1,125 @@
+"""
+Prefetching of the inputs of the next recordings while the current one is analysed.
+
+On a network filesystem, reading the audio file and TextGrid of a recording
+can take as long as analysing it. A Prefetcher loads the inputs of the next
+`depth` recordings in background threads, so these reads overlap with the
+analysis. The loads only copy bytes (stage_recording copies the audio file and
+TextGrid to a local directory), which releases the GIL. Decoding is left to
+the process that analyses the recording: parselmouth holds the GIL, so
+decoding in a thread would not overlap with an analysis in the same process.
+
+How much is prefetched is bounded by a budget: no new recording is loaded
+while the recordings that are loading or loaded and not released yet would
+take more than max_bytes. The size of a recording is reserved when its load
+starts, so the loads in flight count as well. One recording is always loaded,
+so a recording larger than the budget is still analysed.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetched:
+    """The loaded inputs of one item (None if loading failed), their size in bytes and the loading error."""
+
+    def __init__(self, value=None, nbytes=0, error=None, cleanup=None):
+        self.value = value
+        self.nbytes = nbytes
+        self.error = error
+        self.cleanup = cleanup
+
+
+class Prefetcher:
+    """
+    Loads items with load(item) in `depth` background threads, ahead of the
+    caller. size(item) is the size in bytes that is reserved in the budget
+    before the load starts. load returns the loaded value, its size in bytes
+    and a function to call on release (or None). iterate yields every item with
+    its Prefetched inputs, in order; call release when they are no longer needed.
+    """
+
+    def __init__(self, load, size, depth=2, max_bytes=2 * 1024 ** 3):
+        self.load = load
+        self.size = size
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._lock = threading.Lock()
+
+    def _load(self, item, reserved):
+        try:
+            value, nbytes, cleanup = self.load(item)
+        except Exception as e:
+            return Prefetched(nbytes=reserved, error=e)
+        with self._lock:
+            self.nbytes += nbytes - reserved
+        return Prefetched(value, nbytes, cleanup=cleanup)
+
+    def release(self, prefetched):
+        if prefetched.cleanup is not None:
+            prefetched.cleanup()
+        with self._lock:
+            self.nbytes -= prefetched.nbytes
+        prefetched.value = None
+
+    def iterate(self, items):
+        items = iter(items)
+        done = object()
+        item = next(items, done)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.depth) as executor:
+            try:
+                while True:
+                    # Keep up to depth items loading or loaded, as long as the budget allows
+                    while item is not done and len(pending) < self.depth:
+                        reserved = self.size(item)
+                        with self._lock:
+                            if pending and self.nbytes + reserved > self.max_bytes:
+                                break
+                            self.nbytes += reserved
+                        pending.append((item, executor.submit(self._load, item, reserved)))
+                        item = next(items, done)
+                    if not pending:
+                        return
+                    loaded, future = pending.popleft()
+                    yield loaded, future.result()
+            finally:
+                # Also when the caller stops early: release what was loaded but never used
+                for loaded, future in pending:
+                    self.release(future.result())
+
+
+def recording_size(audio_file, textgrid_file):
+    """The total size of the audio file and TextGrid, 0 for files that cannot be read (their load fails)."""
+    size = 0
+    for path in [audio_file, textgrid_file]:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+def stage_recording(audio_file, textgrid_file, staging_dir):
+    """
+    Copy the audio file and TextGrid to a directory of their own in
+    staging_dir. The copies keep the name and modification time of the
+    originals, so the audio cache, track cache and manifest treat them as the
+    same files. Returns their paths, their total size and the function that
+    removes them.
+    """
+    directory = tempfile.mkdtemp(dir=staging_dir)
+    try:
+        staged = {}
+        for name, path in [('audio_file', audio_file), ('textgrid_file', textgrid_file)]:
+            staged[name] = shutil.copy2(path, os.path.join(directory, os.path.basename(path)))
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    nbytes = sum(os.path.getsize(path) for path in staged.values())
+    return staged, nbytes, lambda: shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,97 @@
+"""
+Per-stage profiling of extraction runs (--profile of run_LabeledSegmentsAnalysis_v3.py).
+
+A RecordingProfile collects the wall time of every stage of the analysis of
+one recording (decoding, the Pitch, Intensity and Formant analyses, the
+segment statistics, writing the results, ...), its audio duration and number
+of segments. The driver writes one JSON line per recording with these values
+and its peak RSS, and a summary line with the throughput of the run.
+
+On Linux, the peak RSS of the process (VmHWM) is reset when the profile of a
+recording is created, so peak_rss_mb is the peak while that recording was
+analysed. Elsewhere, or when the reset is not allowed, only the peak of the
+whole process (ru_maxrss) is known. It is then written as process_peak_rss_mb:
+in a serial run, or in a worker that analyses several recordings, a recording
+reports the highest peak of all recordings analysed before it in that process
+too.
+"""
+
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class RecordingProfile:
+    """Wall time per stage and other values (audio duration, segments) of one recording."""
+
+    def __init__(self):
+        self.stages = {}
+        self.values = {}
+        self.peak_rss_reset = reset_peak_rss()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def stage(profile, name):
+    """Time the stage `name` in profile, or do nothing if profile is None."""
+    return nullcontext() if profile is None else profile.stage(name)
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process to its current RSS (Linux only). Returns whether it was reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process, since the last reset_peak_rss on Linux (VmHWM, in kilobytes)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def recording_metrics(soundname, profile, wall_time):
+    peak_column = 'peak_rss_mb' if profile.peak_rss_reset else 'process_peak_rss_mb'
+    return {'type': 'recording', 'recording': soundname,
+            'audio_duration': profile.values.get('audio_duration'), 'segments': profile.values.get('segments'),
+            'wall_time': wall_time, 'stages': profile.stages, peak_column: peak_rss_mb()}
+
+
+def summarize(records, wall_time):
+    """Throughput of a run: segments and audio seconds per second of wall time, and the total time per stage."""
+    segments = sum(record['segments'] or 0 for record in records)
+    audio_duration = sum(record['audio_duration'] or 0.0 for record in records)
+    stages = {}
+    peaks = [record.get('peak_rss_mb', record.get('process_peak_rss_mb')) for record in records]
+    for record in records:
+        for name, seconds in record['stages'].items():
+            stages[name] = stages.get(name, 0.0) + seconds
+    return {'type': 'summary', 'recordings': len(records), 'segments': segments, 'audio_duration': audio_duration,
+            'wall_time': wall_time,
+            'segments_per_second': segments / wall_time if wall_time > 0 else None,
+            'audio_seconds_per_second': audio_duration / wall_time if wall_time > 0 else None,
+            'stages': stages, 'peak_rss_mb': max(peaks, default=None)}
+
+
+def append_metrics(path, record):
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
@@ -8,12 +8,229 @@ Date created: 15 October 2024
 """
 
 
-import parselmouth
-from parselmouth.praat import call, run_file
+from parselmouth.praat import run_file
 import os
 import glob
 import argparse
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
+from audio_cache import AudioCache
+from manifest import append_manifest, load_manifest, manifest_path, recording_key
+from prefetch import Prefetcher, recording_size, stage_recording
+from profiling import RecordingProfile, append_metrics, recording_metrics, stage, summarize
+from segment_analysis import DEFAULT_SETTINGS, analyze_file
+from segment_tables import TABLE_EXTENSIONS
+from sharding import BALANCE, parse_shard, recording_weights, select_shard, shard_dir
+from textgrid_index import load_textgrid
+from track_cache import TrackCache
+
+
+def job_soundname(job):
+    return os.path.basename(job['textgrid_file'])[:-len(job['tg_extension'])]
+
+
+def job_audio_file(job):
+    return os.path.join(job['audio_dir'], job_soundname(job) + job['audio_extension'])
+
+
+def job_result_files(job):
+    # With one tier the result file is named after the recording, with several tiers the tier is added to the name
+    extension = TABLE_EXTENSIONS.get(job['output_format'], '.txt')
+    if len(job['tier_numbers']) == 1:
+        return {job['tier_numbers'][0]: os.path.join(job['output_dir'], job_soundname(job) + extension)}
+    return {tier_number: os.path.join(job['output_dir'], f'{job_soundname(job)}_tier{tier_number}_results{extension}')
+            for tier_number in job['tier_numbers']}
+
+
+def job_key(job):
+    # Manifest key of a job, None if the audio file or TextGrid cannot be read
+    options = {name: job[name] for name in ['engine', 'output_format', 'measures', 'tier_numbers', 'match_label', 'begin_end_labels', 'settings']}
+    # Cached audio is mono, which can change the results of stereo recordings
+    options['audio_cache'] = job['audio_cache'] is not None
+    if job['window'] is not None:
+        # Only added when set, so the keys of earlier runs stay valid
+        options['window'] = job['window']
+    try:
+        return recording_key(job_audio_file(job), job['textgrid_file'], options)
+    except OSError:
+        return None
+
+
+def job_done(job, manifest, output_dir):
+    # Whether manifest (of output_dir) has the key of the job and all its result files are in output_dir
+    if job['key'] is None or manifest.get(job_soundname(job)) != job['key']:
+        return False
+    return all(os.path.exists(result_file) for result_file in job_result_files(dict(job, output_dir=output_dir)).values())
+
+
+def restore_audio_dir(result_file, staged_audio_dir, audio_dir):
+    # The script writes the audio directory it was given at the start of the header line; put the real one back
+    with open(result_file, 'rb') as f:
+        data = f.read()
+    # Praat writes UTF-16 (with a byte order mark) when a label is not ASCII
+    bom = data[:2] if data.startswith((b'\xff\xfe', b'\xfe\xff')) else b''
+    encoding = {b'\xff\xfe': 'utf-16-le', b'\xfe\xff': 'utf-16-be'}.get(bom, 'utf-8')
+    text = data[len(bom):].decode(encoding, errors='surrogateescape')
+    if text.startswith(staged_audio_dir):
+        text = audio_dir + text[len(staged_audio_dir):]
+        with open(result_file, 'wb') as f:
+            f.write(bom + text.encode(encoding, errors='surrogateescape'))
+
+
+def run_praat_script(job, profile=None, inputs=None):
+    # The Praat script analyses every TextGrid in a directory, so give it a directory with only this TextGrid
+    # With a profile, only decoding into the audio cache and the script as a whole can be timed
+    # inputs has the paths of the prefetched copies of the audio file and TextGrid (see prefetch.py)
+    settings = job['settings']
+    inputs = inputs or {}
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        textgrid_dir = os.path.join(temporary_dir, 'textgrid', '')
+        os.makedirs(textgrid_dir)
+        textgrid_file = inputs.get('textgrid_file', job['textgrid_file'])
+        os.symlink(os.path.abspath(textgrid_file), os.path.join(textgrid_dir, os.path.basename(textgrid_file)))
+
+        # The audio directory also gets one of its own: the script writes analysis.info into it, which
+        # would be a race between the workers in the real audio directory (run writes that file once)
+        # Praat recognises a cached WAV by its header, so it can keep the name of the original audio file
+        # (the script itself looks for .mp3 files)
+        audio_dir = os.path.join(temporary_dir, 'audio', '')
+        os.makedirs(audio_dir)
+        audio_file = os.path.abspath(inputs.get('audio_file', job_audio_file(job)))
+        if job['audio_cache'] is not None:
+            with stage(profile, 'decode'):
+                audio_file = os.path.abspath(job['audio_cache'].path(audio_file))
+        for extension in {'.mp3', job['audio_extension']}:
+            os.symlink(audio_file, os.path.join(audio_dir, job_soundname(job) + extension))
+
+        # The script analyses one tier per run and always writes <soundname>.txt
+        for tier_number, result_file in job_result_files(job).items():
+            with stage(profile, 'praat_script'):
+                run_file('./LabeledSegmentsAnalysis_v3.praat', audio_dir, textgrid_dir, job['output_dir'], '*' + job['audio_extension'], '.txt', '', job['tg_extension'], tier_number, job['match_label'], job['begin_end_labels'], True, True, True, True, True, True,
+                         settings['time_step'], settings['pitch_floor'], settings['pitch_ceiling'], settings['max_number_of_formants'], settings['maximum_formant'], settings['window_length'], settings['preemphasis_from'])
+            script_result_file = os.path.join(job['output_dir'], job_soundname(job) + '.txt')
+            restore_audio_dir(script_result_file, audio_dir, job['audio_dir'])
+            if result_file != script_result_file:
+                os.replace(script_result_file, result_file)
+
+    if profile is not None:
+        # The duration of the TextGrid is the duration of the audio, the number of segments is written after tot_int
+        textgrid = load_textgrid(job['textgrid_file'])
+        profile.values['audio_duration'] = textgrid.xmax - textgrid.xmin
+        segments = 0
+        for result_file in job_result_files(job).values():
+            with open(result_file, errors='ignore') as f:
+                segments += int(f.read().split()[-3])
+        profile.values['segments'] = segments
+
+
+def analyze_recording(job, inputs=None):
+    """
+    Analyse one TextGrid and its audio file with the chosen engine.
+    This runs in a worker process when --workers > 1, so every worker has its own Praat state.
+    inputs are the prefetched inputs (see prefetch.py): the paths of local copies
+    of the audio file and TextGrid.
+    Returns the sound name, the error message (None if the analysis succeeded)
+    and the metrics of the recording (None if it is not profiled, see profiling.py).
+    """
+    soundname = job_soundname(job)
+    profile = RecordingProfile() if job['profile'] else None
+    inputs = inputs or {}
+    start = time.perf_counter()
+    try:
+        if job['engine'] == 'parselmouth':
+            input_files = os.path.join(job['audio_dir'], '') + '*' + job['audio_extension']
+            analyze_file(inputs.get('audio_file', job_audio_file(job)), inputs.get('textgrid_file', job['textgrid_file']), job_result_files(job), input_files,
+                         job['match_label'], job['begin_end_labels'], job['settings'], job['measures'], job['audio_cache'], job['track_cache'], profile, job['window'])
+        else:
+            run_praat_script(job, profile, inputs)
+    except Exception as e:
+        return soundname, str(e), None
+    if profile is None:
+        return soundname, None, None
+    return soundname, None, recording_metrics(soundname, profile, time.perf_counter() - start)
+
+
+class WorkerPool:
+    """
+    Process pool for analyze_recording that survives the death of a worker
+    process (killed for lack of memory, a crash in Praat). Every job that was
+    running or waiting in the pool when a worker died fails with it; such a job
+    is run again on its own in a new process, so only the job that killed its
+    worker is reported as failed (and left out of the manifest, so the next run
+    tries it again).
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def submit(self, job, inputs=None):
+        try:
+            return self.executor.submit(analyze_recording, job, inputs)
+        except BrokenProcessPool:
+            self.executor.shutdown(wait=False)
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self.executor.submit(analyze_recording, job, inputs)
+
+    def result(self, job, future, inputs=None):
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                try:
+                    return executor.submit(analyze_recording, job, inputs).result()
+                except BrokenProcessPool:
+                    return job_soundname(job), 'The worker process died while analysing this file (out of memory or a crash)', None
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def pool_results(jobs, pool, queue_size):
+    """The results of analyze_recording for all jobs in a WorkerPool, in order, with at most queue_size jobs submitted at a time."""
+    pending = deque()
+    for job in jobs:
+        pending.append((job, pool.submit(job)))
+        if len(pending) >= queue_size:
+            job, future = pending.popleft()
+            yield pool.result(job, future)
+    while pending:
+        job, future = pending.popleft()
+        yield pool.result(job, future)
+
+
+def prefetched_results(jobs, prefetcher, executor=None, queue_size=1):
+    """
+    The results of analyze_recording for all jobs, in order, while the prefetcher
+    loads the inputs of the next jobs. With an executor (a WorkerPool), at most
+    queue_size jobs are submitted at a time, and their inputs are released when
+    they are done.
+    """
+    pending = deque()
+    for job, prefetched in prefetcher.iterate(jobs):
+        # If loading failed, the analysis reads the files itself and reports the error
+        inputs = prefetched.value if prefetched.error is None else None
+        if executor is None:
+            result = analyze_recording(job, inputs)
+            prefetcher.release(prefetched)
+            yield result
+            continue
+        pending.append((job, inputs, prefetched, executor.submit(job, inputs)))
+        if len(pending) >= queue_size:
+            job, inputs, prefetched, future = pending.popleft()
+            result = executor.result(job, future, inputs)
+            prefetcher.release(prefetched)
+            yield result
+    while pending:
+        job, inputs, prefetched, future = pending.popleft()
+        result = executor.result(job, future, inputs)
+        prefetcher.release(prefetched)
+        yield result
 
 
 def run(args):
@@ -23,39 +240,170 @@ def run(args):
     outputDir = args.lsaFeatureTxtDir
     audioExtension = args.audioExtension
 
-    if not os.path.exists(outputDir):
-        os.makedirs(outputDir)
+    if args.outputFormat != 'txt' and args.engine != 'parselmouth':
+        raise ValueError('The Praat script can only write .txt result files, use --engine parselmouth for --outputFormat ' + args.outputFormat)
+    if args.measures != 'segment' and args.engine != 'parselmouth':
+        raise ValueError('--measures ' + args.measures + ' is only available with --engine parselmouth')
+    if args.trackCache and args.engine != 'parselmouth':
+        raise ValueError('--trackCache is only available with --engine parselmouth')
+    if args.window is not None and args.engine != 'parselmouth':
+        raise ValueError('--window is only available with --engine parselmouth')
+    if args.window is not None and args.trackCache:
+        raise ValueError('--window cannot be combined with --trackCache, the tracks of a windowed analysis are not cached')
+    if args.analysisRate is not None and args.engine != 'parselmouth':
+        raise ValueError('--analysisRate is only available with --engine parselmouth')
+    if args.analysisRate is not None and args.window is not None:
+        raise ValueError('--analysisRate cannot be combined with --window')
 
     audio_dir = audioDir
     textgrid_dir = textgridDir
     output_dir = outputDir
-    audio_extension = '*' + audioExtension
 
-    result_file = '.txt'
-    suffix_tg_file_names = ''
     tg_extension = '.TextGrid'
 
+    # One job per TextGrid, in the same order as 'Create Strings as file list' in the Praat script
+    textgrid_files = sorted(glob.glob(os.path.join(textgrid_dir, '*' + tg_extension)))
+
+    if args.shard is not None:
+        # Only the recordings of this shard, written to a directory of its own next to the output directory
+        # (combine the shards with merge_shards.py)
+        shard = parse_shard(args.shard)
+        soundnames = [os.path.basename(textgrid_file)[:-len(tg_extension)] for textgrid_file in textgrid_files]
+        audio_files = [os.path.join(audio_dir, soundname + audioExtension) for soundname in soundnames]
+        weights = recording_weights(audio_files, textgrid_files, args.shardBalance)
+        textgrid_files = select_shard(textgrid_files, soundnames, weights, shard)
+        output_dir = shard_dir(outputDir, *shard)
+        print(f'Shard {shard[0]} of {shard[1]}: {len(textgrid_files)} files, results in {output_dir}')
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
     # If textgrid is created from WhisperTimestamped json-asr-result (with script asr-results-to-textgrids):
     # Tier 1: wordsDisTier
     # Tier 2: wordsTier
     # Tier 3: confTier
     # Tier 4: segmentsTier
-    tier_number = 2 # wordsTier
+    # Several tiers can be given as a comma-separated list, e.g. 1,2,4; every recording is then analysed once for all of them
+    tier_numbers = [int(tier_number) for tier_number in args.tierNumber.split(',')]
     match_label = '*'
     begin_end_labels = 'SIL'
 
-    try:
-        run_file('./LabeledSegmentsAnalysis_v3.praat', audio_dir, textgrid_dir, output_dir, audio_extension, result_file, suffix_tg_file_names, tg_extension, 2, '*', 'SIL', True, True, True, True, True, True, 0.0, 75, 600, 5, 5500, 0.025, 50)
-    except Exception as e:
-        print(f'Error encountered: {e}')
+    settings = DEFAULT_SETTINGS
+    if args.analysisRate is not None:
+        # Only added when set, so the manifest and track cache keys of earlier runs stay valid
+        settings = dict(DEFAULT_SETTINGS, analysis_rate=args.analysisRate if args.analysisRate == 'formant' else float(args.analysisRate))
+
+    audio_cache = None
+    if args.audioCache:
+        audio_cache = AudioCache(args.audioCache, int(args.audioCacheSize * 1024 ** 3))
+
+    track_cache = None
+    if args.trackCache:
+        track_cache = TrackCache(args.trackCache)
+
+    jobs = [{'engine': args.engine, 'textgrid_file': textgrid_file, 'audio_dir': os.path.join(audio_dir, ''),
+             'output_dir': os.path.join(output_dir, ''), 'audio_extension': audioExtension, 'tg_extension': tg_extension,
+             'tier_numbers': tier_numbers, 'match_label': match_label, 'begin_end_labels': begin_end_labels,
+             'output_format': args.outputFormat, 'measures': args.measures, 'audio_cache': audio_cache, 'track_cache': track_cache, 'settings': settings,
+             'window': args.window, 'profile': args.profile is not None} for textgrid_file in textgrid_files]
+
+    # Skip the recordings that were already analysed with the same input files and settings
+    manifest_file = manifest_path(output_dir)
+    manifest = {} if args.force else load_manifest(manifest_file)
+    # A shard also skips the recordings that are in the merged results of earlier runs (see merge_shards.py)
+    merged_manifest = {} if args.force or args.shard is None else load_manifest(manifest_path(outputDir))
+    todo = []
+    for job in jobs:
+        job['key'] = job_key(job)
+        if not job_done(job, manifest, job['output_dir']) and not job_done(job, merged_manifest, os.path.join(outputDir, '')):
+            todo.append(job)
+    if len(todo) < len(jobs):
+        print(f'Skipping {len(jobs) - len(todo)} of {len(jobs)} files that are unchanged since the last run.')
+
+    if args.profile is not None:
+        # A new metrics file for every run
+        open(args.profile, 'w').close()
+    records = []
+    start = time.perf_counter()
+
+    executor = None
+    if args.workers > 1:
+        executor = WorkerPool(args.workers)
+
+    staging_dir = None
+    if args.prefetch > 0:
+        # The files are copied to a local directory in background threads, and decoded by the process that analyses them
+        staging_dir = tempfile.mkdtemp(prefix='prefetch_', dir=args.prefetchDir)
+        load = lambda job: stage_recording(job_audio_file(job), job['textgrid_file'], staging_dir)
+        size = lambda job: recording_size(job_audio_file(job), job['textgrid_file'])
+        prefetcher = Prefetcher(load, size, args.prefetch, int(args.prefetchBudget * 1024 ** 3))
+        results = prefetched_results(todo, prefetcher, executor, 2 * args.workers)
+    elif executor is not None:
+        results = pool_results(todo, executor, 2 * args.workers)
+    else:
+        results = map(analyze_recording, todo)
+
+    failed = []
+    analysed = []
+    for job, (soundname, error, metrics) in zip(todo, results):
+        if error is not None:
+            print(f'Error encountered in {soundname}: {error}')
+            failed.append(soundname)
+            continue
+        analysed.append(soundname)
+        if args.engine == 'parselmouth':
+            print(f'File: {soundname}')
+        # Written as soon as a file is done, so a crashed run resumes where it stopped
+        if job['key'] is not None:
+            append_manifest(manifest_file, soundname, job['key'])
+        if metrics is not None:
+            append_metrics(args.profile, metrics)
+            records.append(metrics)
+
+    if executor is not None:
+        executor.shutdown()
+    if staging_dir is not None:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    if args.engine == 'praat' and analysed:
+        # The info window of the Praat script, which it writes to analysis.info in the audio directory;
+        # every job runs the script on a directory of its own, so it is written here once
+        with open(os.path.join(audio_dir, 'analysis.info'), 'w') as f:
+            f.write(''.join(f'File: {soundname}\n' for soundname in analysed))
+
+    if failed:
+        print(f'{len(failed)} of {len(todo)} files failed: {", ".join(failed)}')
+
+    if args.profile is not None:
+        summary = summarize(records, time.perf_counter() - start)
+        append_metrics(args.profile, summary)
+        if records and summary['wall_time'] > 0:
+            print(f"{summary['recordings']} files, {summary['segments']} segments, {summary['audio_duration']:.0f} s of audio in {summary['wall_time']:.1f} s: "
+                  f"{summary['segments_per_second']:.1f} segments/s, {summary['audio_seconds_per_second']:.1f} audio s/s")
 
 def main():
     parser = argparse.ArgumentParser("Message")
     parser.add_argument("--audioDir", type=str, help = "Path to audio directory.")
     parser.add_argument("--audioExtension", type=str, help = "Audio extension")
     parser.add_argument("--textGridDir", type=str, help = "Dir to TextGrids that are created from json-asr-results.")
-    parser.add_argument("--tierNumber", type=str, help = "Tier number of tier with segments that should be analysed")
+    parser.add_argument("--tierNumber", type=str, default="2", help = "Tier number of tier with segments that should be analysed, or a comma-separated list of tier numbers (e.g. 1,2,4)")
     parser.add_argument("--lsaFeatureTxtDir", type=str, help = "Output dir")
+    parser.add_argument("--engine", type=str, default="praat", choices=["praat", "parselmouth"], help = "Run LabeledSegmentsAnalysis_v3.praat or the native parselmouth engine (segment_analysis.py)")
+    parser.add_argument("--workers", type=int, default=1, help = "Number of worker processes, the TextGrids are divided over them")
+    parser.add_argument("--outputFormat", type=str, default="txt", choices=["txt", "npz", "parquet"], help = "Result file per recording: Praat-style .txt line or a columnar segment table (parselmouth engine only)")
+    parser.add_argument("--measures", type=str, default="segment", choices=["segment", "whole_file"], help = "Compute pitch variability and centre of gravity per segment (like the Praat script) or from whole-file analyses (parselmouth engine only)")
+    parser.add_argument("--audioCache", type=str, default=None, help = "Directory of the decoded-audio cache (shared with ExtractingFeatures_openSMILE.py), no cache if not given")
+    parser.add_argument("--audioCacheSize", type=float, default=50, help = "Maximum size of the decoded-audio cache in GB")
+    parser.add_argument("--trackCache", type=str, default=None, help = "Directory to cache the pitch/intensity/formant tracks per recording, so runs with another tier or label filter skip the signal analysis (parselmouth engine only)")
+    parser.add_argument("--window", type=float, default=None, help = "Analyse every recording in windows of about this many seconds around the segments instead of as a whole, so memory use does not grow with the length of the recording (parselmouth engine only)")
+    parser.add_argument("--analysisRate", type=str, default=None, help = "Resample the audio to this sampling frequency (Hz) before all analyses, or 'formant' for twice the maximum formant (11000 Hz); see benchmarks/analysis_rate.py for the deviations from full-rate results (parselmouth engine only)")
+    parser.add_argument("--shard", type=str, default=None, help = "Only analyse shard i of N (i/N, i counts from 0), e.g. the task id of an array job; the results go to <lsaFeatureTxtDir>.shard-i-of-N, combine them with merge_shards.py")
+    parser.add_argument("--shardBalance", type=str, default="duration", choices=BALANCE, help = "Balance the shards on the duration of the recordings (from the TextGrids) or on the size of the audio files")
+    parser.add_argument("--prefetch", type=int, default=0, help = "Copy the audio files and TextGrids of this many next recordings to a local directory in background threads while the current ones are analysed, 0: no prefetching")
+    parser.add_argument("--prefetchBudget", type=float, default=2, help = "Maximum size in GB of the prefetched recordings that are being copied or waiting to be analysed")
+    parser.add_argument("--prefetchDir", type=str, default=None, help = "Local directory for the prefetched copies of the audio files and TextGrids (default: the system's temporary directory)")
+    parser.add_argument("--force", action="store_true", help = "Analyse all files, also the ones that are unchanged since the last run")
+    parser.add_argument("--profile", type=str, default=None, help = "Write the time per stage, audio duration, number of segments and peak memory of every file, and a throughput summary, to this .jsonl file")
     
     
     parser.set_defaults(func=run)
@@ -0,0 +1,177 @@
+"""
+This script computes the audio features over the labeled segments of every
+TextGrid in the input and writes them straight into one feature table, in a
+single pass.
+
+It replaces running run_LabeledSegmentsAnalysis_v3.py and then
+organizing_PraatFeatures.py (see uber.sh): the features of every recording go
+from the workers through a bounded queue into a table writer, so the rows
+appear in the table while the other recordings are still analysed, memory use
+does not grow with the number of recordings, and no result files are written
+and parsed again. The .txt result files are only written when --lsaFeatureTxtDir
+is given.
+
+The rows and columns are the ones of organizing_PraatFeatures.py for segment
+tables (one row per segment, with its start and end time).
+"""
+
+
+import os
+import glob
+import argparse
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from aggregation import FILE_NAME_PATTERN, LEVELS, STATISTICS, write_aggregates
+from audio_cache import AudioCache
+from feature_tables import TableWriter, read_table
+from organizing_PraatFeatures import participant_from_filename
+from run_LabeledSegmentsAnalysis_v3 import job_audio_file, job_result_files, job_soundname
+from segment_analysis import DEFAULT_SETTINGS, analyze_segments, write_result
+from segment_tables import segment_table
+from track_cache import TrackCache
+
+
+TYPE_OF_SPEECH = 'lsa_features' #'class' label, as in organizing_PraatFeatures.py
+
+
+def recording_rows(job):
+    """
+    Analyse one recording, write its .txt result files if requested and return
+    its segments as rows of the feature table (None if the analysis failed)
+    and the error message.
+    """
+    try:
+        results = analyze_segments(job_audio_file(job), job['textgrid_file'], job['tier_numbers'], job['match_label'], job['begin_end_labels'],
+                                   job['settings'], job['measures'], job['audio_cache'], job['track_cache'], window=job['window'])
+        blocks = []
+        for tier_number, result_file in job_result_files(job).items():
+            starts, ends, labels, features = results[tier_number]
+            if job['write_txt']:
+                header = job['audio_dir'] + '*' + job['audio_extension'] + ', Tier number ' + str(tier_number)
+                write_result(result_file, header, job_soundname(job), starts, ends, labels, features)
+
+            block = pd.DataFrame(segment_table(job_soundname(job), starts, ends, labels, features)).drop(['file_name', 'segment'], axis=1)
+            block['class'] = TYPE_OF_SPEECH
+            block['participant'] = participant_from_filename(os.path.basename(result_file))
+            block['file_name'] = os.path.splitext(os.path.basename(result_file))[0]
+            blocks.append(block)
+        return pd.concat(blocks, ignore_index=True), None
+    except Exception as e:
+        return None, str(e)
+
+
+def stream_rows(jobs, workers, queue_size):
+    """
+    Yield the job and the result of recording_rows for every job, in the order of jobs.
+    At most queue_size recordings are analysed or waiting to be written at the same time.
+    """
+    if workers <= 1:
+        for job in jobs:
+            yield job, recording_rows(job)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append((job, executor.submit(recording_rows, job)))
+            if len(pending) >= queue_size:
+                job, future = pending.popleft()
+                yield job, future.result()
+        while pending:
+            job, future = pending.popleft()
+            yield job, future.result()
+
+
+def run(args):
+    tg_extension = '.TextGrid'
+    tier_numbers = [int(tier_number) for tier_number in args.tierNumber.split(',')]
+
+    table_dir = os.path.dirname(os.path.abspath(args.lsaFeatureTotalFile))
+    write_txt = args.lsaFeatureTxtDir is not None
+    output_dir = args.lsaFeatureTxtDir if write_txt else table_dir
+    for directory in [table_dir, output_dir]:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    audio_cache = None
+    if args.audioCache:
+        audio_cache = AudioCache(args.audioCache, int(args.audioCacheSize * 1024 ** 3))
+
+    if args.window is not None and args.trackCache:
+        raise ValueError('--window cannot be combined with --trackCache, the tracks of a windowed analysis are not cached')
+
+    if args.analysisRate is not None and args.window is not None:
+        raise ValueError('--analysisRate cannot be combined with --window')
+    settings = DEFAULT_SETTINGS
+    if args.analysisRate is not None:
+        settings = dict(DEFAULT_SETTINGS, analysis_rate=args.analysisRate if args.analysisRate == 'formant' else float(args.analysisRate))
+
+    track_cache = None
+    if args.trackCache:
+        track_cache = TrackCache(args.trackCache)
+
+    textgrid_files = sorted(glob.glob(os.path.join(args.textGridDir, '*' + tg_extension)))
+    jobs = [{'textgrid_file': textgrid_file, 'audio_dir': os.path.join(args.audioDir, ''), 'output_dir': os.path.join(output_dir, ''),
+             'audio_extension': args.audioExtension, 'tg_extension': tg_extension, 'tier_numbers': tier_numbers,
+             'match_label': '*', 'begin_end_labels': 'SIL', 'output_format': 'txt', 'write_txt': write_txt, 'measures': args.measures,
+             'audio_cache': audio_cache, 'track_cache': track_cache, 'window': args.window, 'settings': settings} for textgrid_file in textgrid_files]
+
+    queue_size = args.queueSize if args.queueSize is not None else 2 * args.workers
+    start = time.perf_counter()
+    failed = []
+    with TableWriter(args.lsaFeatureTotalFile) as writer:
+        for job, (rows, error) in stream_rows(jobs, args.workers, queue_size):
+            if error is not None:
+                print(f'Error encountered in {job_soundname(job)}: {error}')
+                failed.append(job_soundname(job))
+                continue
+            writer.write(rows)
+            print(f'File: {job_soundname(job)} ({writer.rows} segments written after {time.perf_counter() - start:.1f} s)')
+
+    if failed:
+        print(f'{len(failed)} of {len(jobs)} files failed: {", ".join(failed)}')
+    if writer.rows == 0:
+        #Nothing to summarize; the table is not written (or only has a header) when no recording has segments
+        print("No segments were written to " + os.path.basename(args.lsaFeatureTotalFile) + ".")
+        sys.exit(1)
+    print("The file "+ os.path.basename(args.lsaFeatureTotalFile) + " is created.")
+
+    if args.aggregate:
+        quantiles = [float(q) for q in args.quantiles.split(',') if q]
+        for level_file in write_aggregates(read_table(args.lsaFeatureTotalFile), args.lsaFeatureTotalFile, args.aggregate.split(','),
+                                           args.fileNamePattern, args.statistics.split(','), quantiles):
+            print("The file "+ os.path.basename(level_file) + " is created.")
+
+
+def main():
+    parser = argparse.ArgumentParser("Message")
+    parser.add_argument("--audioDir", type=str, help = "Path to audio directory.")
+    parser.add_argument("--audioExtension", type=str, help = "Audio extension")
+    parser.add_argument("--textGridDir", type=str, help = "Dir to TextGrids that are created from json-asr-results.")
+    parser.add_argument("--tierNumber", type=str, default="2", help = "Tier number of tier with segments that should be analysed, or a comma-separated list of tier numbers (e.g. 1,2,4)")
+    parser.add_argument("--lsaFeatureTotalFile", type=str, help = "Feature table (.parquet, .feather or .tsv), written while the recordings are analysed")
+    parser.add_argument("--lsaFeatureTxtDir", type=str, default=None, help = "Also write the .txt result file of every recording to this dir")
+    parser.add_argument("--workers", type=int, default=1, help = "Number of worker processes")
+    parser.add_argument("--queueSize", type=int, default=None, help = "Maximum number of recordings that are analysed or waiting to be written (default: 2 x workers)")
+    parser.add_argument("--measures", type=str, default="segment", choices=["segment", "whole_file"], help = "Compute pitch variability and centre of gravity per segment (like the Praat script) or from whole-file analyses")
+    parser.add_argument("--audioCache", type=str, default=None, help = "Directory of the decoded-audio cache (shared with ExtractingFeatures_openSMILE.py), no cache if not given")
+    parser.add_argument("--audioCacheSize", type=float, default=50, help = "Maximum size of the decoded-audio cache in GB")
+    parser.add_argument("--trackCache", type=str, default=None, help = "Directory to cache the pitch/intensity/formant tracks per recording")
+    parser.add_argument("--analysisRate", type=str, default=None, help = "Resample the audio to this sampling frequency (Hz) before all analyses, or 'formant' for twice the maximum formant (11000 Hz)")
+    parser.add_argument("--aggregate", type=str, default=None, help = "Comma-separated summary levels (" + ", ".join(LEVELS) + "), each written to lsaFeatureTotalFile with _<level> added to the name, see organizing_PraatFeatures.py")
+    parser.add_argument("--fileNamePattern", type=str, default=FILE_NAME_PATTERN, help = "Regular expression with the named groups participant, phase and session, matched at the start of every file name")
+    parser.add_argument("--statistics", type=str, default=",".join(STATISTICS), help = "Comma-separated statistics of the summaries: " + ", ".join(STATISTICS) + " (mean weighted by segment duration)")
+    parser.add_argument("--quantiles", type=str, default="0.25,0.75", help = "Comma-separated quantiles of the summaries (empty for none)")
+    parser.add_argument("--window", type=float, default=None, help = "Analyse every recording in windows of about this many seconds around the segments instead of as a whole, so memory use does not grow with the length of the recording")
+
+    parser.set_defaults(func=run)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,767 @@
+"""
+Native parselmouth implementation of LabeledSegmentsAnalysis_v3.praat.
+
+The Praat script asks the interpreter for every statistic of every segment
+separately (Get minimum, Get maximum, Get mean, ...). Here the Pitch, Intensity
+and Formant (burg) objects are computed once per recording, their frames are
+pulled out as NumPy arrays and all per-segment statistics are computed in one
+vectorized pass, using searchsorted on the frame times for all segment
+boundaries at once.
+
+The result files have exactly the same layout as the ones written by the Praat
+script, so organizing_PraatFeatures.py can be used on both.
+
+The statistics follow Praat's own definitions (edge interpolation, parabolic
+extrema, weighting of the partial frames at the segment edges). On a synthetic
+test corpus all values agree with the Praat script within the last written
+decimal, except for a few pitch means and standard deviations of segments with
+unvoiced frames at their edges, which deviate by at most 0.05 Hz.
+"""
+
+import os
+from fractions import Fraction
+
+import numpy as np
+import parselmouth
+from parselmouth.praat import call
+
+from profiling import stage
+from segment_tables import FEATURE_COLUMNS, segment_table, write_segment_table
+from textgrid_index import load_textgrid
+
+
+# Same defaults as the form of LabeledSegmentsAnalysis_v3.praat
+DEFAULT_SETTINGS = {
+    'time_step': 0.0,
+    'pitch_floor': 75,
+    'pitch_ceiling': 600,
+    'max_number_of_formants': 5,
+    'maximum_formant': 5500,
+    'window_length': 0.025,
+    'preemphasis_from': 50,
+}
+
+# Number of formants written to the result file
+NUMBER_OF_FORMANTS = 4
+
+# Short-time spectra for the whole-file centre of gravity
+SPECTRUM_WINDOW_LENGTH = 0.025
+SPECTRUM_TIME_STEP = 0.005
+SPECTRUM_BLOCK_FRAMES = 4096
+
+# Audio added before and after every window of the windowed analysis, so the
+# analyses of the segments at its edges see the same context as in the whole file
+WINDOW_MARGIN = 1.0
+# Maximum time by which the end of a window is moved to align its analysis frames
+ALIGNMENT_SEARCH = 0.1
+# Precision (in samples) of the resampling before the Formant analysis, as in Praat's Sound_to_Formant_burg
+RESAMPLE_PRECISION = 50
+# Zero samples after the audio in the FFT of resample, so its end does not wrap around into its start
+# (as the anti-turnaround padding of Praat's Resample)
+RESAMPLE_PADDING = 1000
+
+def spectral_moments(sound, window_length=SPECTRUM_WINDOW_LENGTH, time_step=SPECTRUM_TIME_STEP):
+    """
+    Short-time power spectra of the whole sound (Hanning windows), reduced to
+    two values per frame: the total power and the frequency-weighted power.
+    Summed over the frames of a segment, their ratio is the centre of gravity
+    (power 2) of the segment. The frames are computed in blocks, so the full
+    spectrogram is never in memory.
+    """
+    samples = sound.values.mean(axis=0)
+    window_samples = int(round(window_length * sound.sampling_frequency))
+    step_samples = max(1, int(round(time_step * sound.sampling_frequency)))
+    number_of_frames = max(0, (len(samples) - window_samples) // step_samples + 1)
+    window = np.hanning(window_samples)
+    frequencies = np.fft.rfftfreq(window_samples, sound.sampling_period)
+
+    moments = np.zeros((2, number_of_frames))
+    for first in range(0, number_of_frames, SPECTRUM_BLOCK_FRAMES):
+        frame_starts = step_samples * np.arange(first, min(first + SPECTRUM_BLOCK_FRAMES, number_of_frames))
+        frames = samples[frame_starts[:, None] + np.arange(window_samples)] * window
+        power = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+        moments[0, first:first + len(frame_starts)] = power.sum(axis=1)
+        moments[1, first:first + len(frame_starts)] = power @ frequencies
+
+    x1 = sound.xmin + window_samples / 2 * sound.sampling_period
+    return x1, step_samples * sound.sampling_period, moments
+
+
+def analysis_rate(settings=DEFAULT_SETTINGS):
+    """
+    The sampling frequency at which the audio is analysed, None for the rate of
+    the audio file. settings['analysis_rate'] is a frequency in Hz or 'formant'
+    for twice the maximum formant, the rate the Formant analysis resamples to.
+    """
+    rate = settings.get('analysis_rate')
+    if rate == 'formant':
+        return 2 * settings['maximum_formant']
+    return rate
+
+
+def _fft_length(minimum):
+    # Smallest 2^a 3^b 5^c >= minimum, for which the FFT is fast
+    best = None
+    power_of_two = 1
+    while power_of_two < 2 * minimum:
+        power_of_three = power_of_two
+        while power_of_three < 2 * minimum:
+            length = power_of_three
+            while length < minimum:
+                length *= 5
+            best = length if best is None else min(best, length)
+            power_of_three *= 3
+        power_of_two *= 2
+    return best
+
+
+def resample(sound, rate):
+    """
+    Downsample sound to rate, on the sample grid of Praat's Resample. The
+    band limit is applied and the new samples are interpolated in a single FFT
+    of the whole sound, instead of Praat's FFT low-pass filter plus a sinc
+    interpolation per sample. The result differs from Praat's Resample by about
+    1e-6 of the signal level and takes a fifth of the time. Rates whose ratio to
+    the sampling frequency is not a simple fraction are left to Praat.
+    """
+    ratio = Fraction(sound.sampling_frequency).limit_denominator(1000) / Fraction(rate).limit_denominator(1000)
+    if abs(float(ratio) - sound.sampling_frequency / rate) > 1e-9 * ratio:
+        return call(sound, 'Resample', rate, RESAMPLE_PRECISION)
+
+    # Same number of samples and first sample time as Praat's Resample
+    resampled = call('Create Sound from formula', 'resampled', sound.n_channels, sound.xmin, sound.xmax, rate, '0')
+    # With an FFT length that is a multiple of the numerator, the inverse FFT of the kept
+    # (band-limited) bins gives the samples on a grid that is exactly ratio old samples apart
+    multiple = _fft_length(-(-(sound.nx + RESAMPLE_PADDING) // ratio.numerator))
+    length, resampled_length = multiple * ratio.numerator, multiple * ratio.denominator
+    kept = resampled_length // 2 + 1
+    offset = (resampled.x1 - sound.x1) / sound.dx
+    spectrum = np.fft.rfft(sound.values, length)[:, :kept] * np.exp(2j * np.pi * np.arange(kept) * offset / length)
+    if resampled_length % 2 == 0:
+        spectrum[:, -1] = 0
+    resampled.values[:] = np.fft.irfft(spectrum, resampled_length)[:, :resampled.nx] * (resampled_length / length)
+    return resampled
+
+
+def resample_for_analysis(sound, settings=DEFAULT_SETTINGS):
+    """The sound resampled to the analysis rate of settings; sounds at or below that rate are not resampled."""
+    rate = analysis_rate(settings)
+    if rate is None or rate >= sound.sampling_frequency:
+        return sound
+    return resample(sound, rate)
+
+
+def analysis_frames(settings=DEFAULT_SETTINGS):
+    """
+    Time step, window duration and resampling frequency (None if the sound is
+    not resampled) of the Pitch, Intensity and Formant analyses, as Praat
+    chooses them for the settings of analyze_audio.
+    """
+    pitch_step = settings['time_step'] if settings['time_step'] > 0 else 0.75 / settings['pitch_floor']
+    formant_step = settings['time_step'] if settings['time_step'] > 0 else settings['window_length'] / 4
+    return {'pitch': (pitch_step, 3 / settings['pitch_floor'], None),
+            'intensity': (0.8 / settings['pitch_floor'], 6.4 / settings['pitch_floor'], None),
+            'formant': (formant_step, 2 * settings['window_length'], 2 * settings['maximum_formant'])}
+
+
+def _first_frame(xmin, xmax, number_of_samples, sampling_period, time_step, window_duration, resample_frequency):
+    """
+    Time of the first analysis frame and of the first (resampled) sample of a
+    sound with number_of_samples samples from xmin to xmax. Praat centres the
+    frames in the sound (Sampled_shortTermAnalysis), and the samples of a
+    resampled sound in its time domain (Sound_resample).
+    """
+    if resample_frequency is not None:
+        number_of_samples = np.round((xmax - xmin) * resample_frequency)
+        sampling_period = 1 / resample_frequency
+    number_of_frames = np.floor((number_of_samples * sampling_period - window_duration) / time_step) + 1
+    centre = (xmin + xmax) / 2
+    return centre - (number_of_frames - 1) / 2 * time_step, centre - (number_of_samples - 1) / 2 * sampling_period
+
+
+def _aligned_part(sound, recording, time_step, window_duration, resample_frequency):
+    """
+    The part of sound, a window of a longer recording with the domain and
+    number of samples in `recording`, whose analysis frames coincide with the
+    frames of the analysis of the whole recording. The part is up to
+    2 * ALIGNMENT_SEARCH seconds shorter than the window: the length of the
+    part sets the number of frames, and shifting the part by one sample
+    shifts its frames by one sample.
+
+    For an analysis that resamples the sound first (Formant), the part is
+    resampled here, after aligning its resampled samples with the ones of the
+    whole recording, and the resampled part is then aligned for the frames.
+    The analysis does not resample it again.
+    """
+    xmin, xmax, number_of_samples = recording
+    sampling_period = sound.sampling_period
+    frame, sample = _first_frame(xmin, xmax, number_of_samples, sampling_period, time_step, window_duration, resample_frequency)
+    # Parts start and end between two samples (a resampled sound does not)
+    first_edge = sound.x1 - sampling_period / 2
+    search = min(sound.n_samples // 3, int(ALIGNMENT_SEARCH / sampling_period))
+    lengths = sound.n_samples - search - np.arange(search)
+    part_frame, part_sample = _first_frame(first_edge, first_edge + lengths * sampling_period, lengths, sampling_period,
+                                           time_step, window_duration, resample_frequency)
+    if resample_frequency is None:
+        shift = np.mod(frame - part_frame, time_step)
+    else:
+        shift = np.mod(sample - part_sample, 1 / resample_frequency)
+    skipped = np.round(shift / sampling_period).astype(int)
+    misalignment = np.where(skipped + lengths <= sound.n_samples, np.abs(shift - skipped * sampling_period), np.inf)
+    best = np.argmin(misalignment)
+    part_start = first_edge + skipped[best] * sampling_period
+    part = call(sound, 'Extract part', part_start, part_start + lengths[best] * sampling_period, 'rectangular', 1, 'yes')
+    if resample_frequency is None:
+        return part
+
+    resampled = call(part, 'Resample', resample_frequency, RESAMPLE_PRECISION)
+    resampled_recording = (xmin, xmax, int(round((xmax - xmin) * resample_frequency)))
+    return _aligned_part(resampled, resampled_recording, time_step, window_duration, None)
+
+
+def analyze_audio(sound, settings=DEFAULT_SETTINGS, measures='segment', profile=None, recording=None):
+    """
+    Compute the Pitch, Intensity and Formant tracks of a whole recording (like
+    AnalyzeAudio in the Praat script) and return their frames as NumPy arrays.
+    Undefined values (unvoiced pitch frames, missing formants) are NaN. With
+    measures='whole_file' the short-time spectral moments are added too.
+    With a RecordingProfile (see profiling.py), every analysis is timed.
+
+    If sound is a window of a longer recording, `recording` gives the domain
+    and number of samples of the whole recording (xmin, xmax, samples). Every
+    analysis then runs on the part of the window whose frames fall on the
+    frames of the whole recording (see _aligned_part); the window must start
+    and end between two samples of the recording.
+    """
+    frames = analysis_frames(settings)
+
+    def analysis_part(analysis):
+        return sound if recording is None else _aligned_part(sound, recording, *frames[analysis])
+
+    with stage(profile, 'pitch'):
+        pitch = call(analysis_part('pitch'), 'To Pitch', settings['time_step'], settings['pitch_floor'], settings['pitch_ceiling'])
+        pitch_values = pitch.selected_array['frequency'].astype(float)
+        pitch_values[pitch_values == 0] = np.nan
+
+    with stage(profile, 'intensity'):
+        intensity = call(analysis_part('intensity'), 'To Intensity', settings['pitch_floor'], 0, 'yes')
+
+    with stage(profile, 'formant'):
+        formant_sound = analysis_part('formant')
+        if analysis_rate(settings) is not None:
+            # To Formant (burg) resamples to twice the maximum formant with Praat's Resample; resample does that faster
+            formant_sound = resample_for_analysis(formant_sound, dict(settings, analysis_rate='formant'))
+        formant = call(formant_sound, 'To Formant (burg)', settings['time_step'], settings['max_number_of_formants'],
+                       settings['maximum_formant'], settings['window_length'], settings['preemphasis_from'])
+        formant_values = np.array([call(formant, 'To Matrix', i + 1).values[0] for i in range(NUMBER_OF_FORMANTS)])
+        formant_values[formant_values == 0] = np.nan
+
+    tracks = {
+        'xmin': sound.xmin,
+        'xmax': sound.xmax,
+        'pitch': (pitch.x1, pitch.dx, pitch_values),
+        'intensity': (intensity.x1, intensity.dx, intensity.values[0].astype(float)),
+        'formant': (formant.x1, formant.dx, formant_values),
+    }
+    if measures == 'whole_file':
+        with stage(profile, 'spectrum'):
+            tracks['spectrum'] = spectral_moments(sound)
+    return tracks
+
+
+def frame_times(track):
+    x1, dx, values = track
+    return x1 + dx * np.arange(values.shape[-1])
+
+
+def value_at_time(track, times, xmin, xmax):
+    """Vectorized linear interpolation of a track, as Sampled_getValueAtX in Praat."""
+    x1, dx, values = track
+    times = np.asarray(times, dtype=float)
+    n = values.shape[-1]
+    ireal = (times - x1) / dx
+    ileft = np.floor(ireal).astype(int)
+    phase = ireal - ileft
+    near_is_left = phase < 0.5
+    inear = np.where(near_is_left, ileft, ileft + 1)
+    ifar = np.where(near_is_left, ileft + 1, ileft)
+    phase = np.where(near_is_left, phase, 1.0 - phase)
+
+    valid_near = (inear >= 0) & (inear < n) & (times >= xmin) & (times <= xmax)
+    valid_far = (ifar >= 0) & (ifar < n)
+    fnear = np.where(valid_near, values[..., np.clip(inear, 0, n - 1)], np.nan)
+    ffar = np.where(valid_far, values[..., np.clip(ifar, 0, n - 1)], np.nan)
+    return np.where(np.isnan(ffar), fnear, fnear + phase * (ffar - fnear))
+
+
+def _reduce_windows(ufunc, values, lo, hi, empty):
+    """Apply ufunc.reduce on values[lo:hi] for every window, empty windows get `empty`."""
+    padded = np.append(values, empty)
+    indices = np.ravel(np.column_stack([lo, hi]))
+    result = ufunc.reduceat(padded, indices)[::2]
+    return np.where(hi > lo, result, empty)
+
+
+def _parabolic_extrema(values):
+    """Per frame, the parabolically interpolated local minimum and maximum value."""
+    left, mid, right = values[:-2], values[1:-1], values[2:]
+    curvature = left - 2 * mid + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vertex = mid - (right - left) ** 2 / (8 * curvature)
+    is_min = (mid < left) & (mid <= right)
+    is_max = (mid > left) & (mid >= right)
+    minima, maxima = values.copy(), values.copy()
+    minima[1:-1] = np.where(is_min & (curvature != 0), vertex, mid)
+    maxima[1:-1] = np.where(is_max & (curvature != 0), vertex, mid)
+    return minima, maxima
+
+
+def _interpolated_moments(track, values, lo, hi, starts, ends, xmin, xmax):
+    """
+    Weighted sums of the linearly interpolated track between starts and ends,
+    as in Sampled_getMean in Praat: every defined frame inside the window
+    counts for one frame step, the first and last frame and the interpolated
+    values at the window edges are weighted by their distance to the edge.
+    Undefined frames drop out together with their share of the window.
+
+    Returns the total weight, the weighted sum and the weighted sum of squares.
+    """
+    x1, dx, _ = track
+    n = len(values)
+    defined = ~np.isnan(values)
+    filled = np.where(defined, values, 0.0)
+    cum_n = np.concatenate([[0], np.cumsum(defined)])
+    cum_sum = np.concatenate([[0.0], np.cumsum(filled)])
+    cum_sq = np.concatenate([[0.0], np.cumsum(filled ** 2)])
+    first = np.clip(lo, 0, n - 1)
+    last = np.clip(hi - 1, 0, n - 1)
+    has_frames = hi > lo
+
+    weight = dx * (cum_n[hi] - cum_n[lo])
+    total = dx * (cum_sum[hi] - cum_sum[lo])
+    total_sq = dx * (cum_sq[hi] - cum_sq[lo])
+
+    left_gap = np.where(has_frames, (x1 + first * dx - starts) / 2, 0.0)
+    right_gap = np.where(has_frames, (ends - x1 - last * dx) / 2, 0.0)
+    edges = value_at_time((x1, dx, values), np.array([starts, ends]), xmin, xmax)
+    for frame, gap, edge in ((first, left_gap, edges[0]), (last, right_gap, edges[1])):
+        correction = np.where(has_frames & defined[frame], gap - dx / 2, 0.0)
+        gap = np.where(np.isnan(edge), 0.0, gap)
+        edge = np.nan_to_num(edge)
+        weight += correction + gap
+        total += correction * filled[frame] + gap * edge
+        total_sq += correction * filled[frame] ** 2 + gap * edge ** 2
+    return weight, total, total_sq
+
+
+def window_statistics(track, starts, ends, xmin, xmax, energy=False, sampled=False):
+    """
+    Minimum, maximum (parabolic), mean and standard deviation of a track for
+    all segments at once. Frames are selected with searchsorted on the frame
+    times; undefined frames (NaN) are ignored. If `energy`, the mean is
+    computed on the energy scale as Intensity 'Get mean... energy' does.
+
+    With `sampled`, the statistics follow Praat's Sampled functions used for
+    Pitch objects: the interpolated values at the segment edges are candidates
+    for the minimum and maximum, and the standard deviation is weighted like
+    the mean. Otherwise they follow the Vector functions used for Intensity
+    objects, which only look at the frames inside the segment.
+    """
+    values = track[2]
+    dx = track[1]
+    times = frame_times(track)
+    lo = np.searchsorted(times, starts, side='left')
+    hi = np.searchsorted(times, ends, side='right')
+    has_frames = hi > lo
+
+    defined = ~np.isnan(values)
+    weight, total, total_sq = _interpolated_moments(track, values, lo, hi, starts, ends, xmin, xmax)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(weight > 0, total / weight, np.nan)
+        if sampled:
+            variance = (total_sq - total * mean) / (weight - dx)
+            std = np.where(weight > dx, np.sqrt(np.maximum(variance, 0.0)), np.nan)
+        else:
+            filled = np.where(defined, values, 0.0)
+            cum_n = np.concatenate([[0], np.cumsum(defined)])
+            cum_sum = np.concatenate([[0.0], np.cumsum(filled)])
+            cum_sq = np.concatenate([[0.0], np.cumsum(filled ** 2)])
+            count = cum_n[hi] - cum_n[lo]
+            frame_sum = cum_sum[hi] - cum_sum[lo]
+            variance = (cum_sq[hi] - cum_sq[lo] - frame_sum ** 2 / count) / (count - 1)
+            std = np.where(count > 1, np.sqrt(np.maximum(variance, 0.0)), np.nan)
+        if energy:
+            energy_weight, energy_total, _ = _interpolated_moments(
+                track, 10 ** (values / 10), lo, hi, starts, ends, xmin, xmax)
+            mean = np.where(energy_weight > 0, 10 * np.log10(energy_total / energy_weight), np.nan)
+    # Segments without frames get the value at their midpoint
+    mean = np.where(has_frames, mean, value_at_time(track, (starts + ends) / 2, xmin, xmax))
+
+    # Local extrema inside the window are refined parabolically, the first and
+    # the last frame of the window are taken as they are
+    if sampled:
+        edges = value_at_time(track, np.array([starts, ends]), xmin, xmax)
+    else:
+        edges = np.full((2, len(starts)), np.nan)
+    minima, maxima = _parabolic_extrema(values)
+    minima = np.where(np.isnan(minima), np.inf, minima)
+    maxima = np.where(np.isnan(maxima), -np.inf, maxima)
+    raw_min = np.where(defined, values, np.inf)
+    raw_max = np.where(defined, values, -np.inf)
+    inner_lo, inner_hi = np.minimum(lo + 1, hi), np.maximum(hi - 1, lo)
+    first = np.clip(lo, 0, len(values) - 1)
+    last = np.clip(hi - 1, 0, len(values) - 1)
+
+    minimum = np.minimum.reduce([
+        _reduce_windows(np.minimum, minima, inner_lo, inner_hi, np.inf),
+        np.where(has_frames, raw_min[first], np.inf),
+        np.where(has_frames, raw_min[last], np.inf),
+        np.where(np.isnan(edges), np.inf, edges).min(axis=0),
+    ])
+    maximum = np.maximum.reduce([
+        _reduce_windows(np.maximum, maxima, inner_lo, inner_hi, -np.inf),
+        np.where(has_frames, raw_max[first], -np.inf),
+        np.where(has_frames, raw_max[last], -np.inf),
+        np.where(np.isnan(edges), -np.inf, edges).max(axis=0),
+    ])
+    minimum[np.isinf(minimum)] = np.nan
+    maximum[np.isinf(maximum)] = np.nan
+    return minimum, maximum, mean, std
+
+
+def pitch_variability(sound, time_begin, time_end, settings=DEFAULT_SETTINGS):
+    """Mean absolute pitch slope of a segment, as PitchVariability in the Praat script."""
+    if (time_end - time_begin) * 1000 < 40:
+        return np.nan
+    part = call(sound, 'Extract part', time_begin, time_end, 'rectangular', 1, 'no')
+    try:
+        pitch = call(part, 'To Pitch', 0, settings['pitch_floor'], settings['pitch_ceiling'])
+        return call(pitch, 'Get mean absolute slope', 'Hertz')
+    except parselmouth.PraatError:
+        return np.nan
+
+
+def centre_of_gravity(sound, time_begin, time_end):
+    """Spectral centre of gravity of a segment, as Gravityvalue in the Praat script."""
+    part = call(sound, 'Extract part', time_begin, time_end, 'Hanning', 1, 'no')
+    spectrum = call(part, 'To Spectrum', 'yes')
+    return call(spectrum, 'Get centre of gravity', 2)
+
+
+def track_pitch_variability(track, starts, ends):
+    """
+    Mean absolute pitch slope of all segments, taken from the whole-file pitch
+    track: the summed absolute differences between consecutive voiced frames
+    divided by the time between the first and last voiced frame of the
+    segment, as 'Get mean absolute slope' computes it for a Pitch object.
+    """
+    x1, dx, values = track
+    voiced = np.flatnonzero(~np.isnan(values))
+    cum_slope = np.concatenate([[0.0], np.cumsum(np.abs(np.diff(values[voiced])))])
+    times = frame_times(track)
+    first = np.searchsorted(voiced, np.searchsorted(times, starts, side='left'))
+    last = np.searchsorted(voiced, np.searchsorted(times, ends, side='right')) - 1
+
+    variability = np.full(len(starts), np.nan)
+    ok = (last - first >= 1) & ((ends - starts) * 1000 >= 40)
+    span = (voiced[last[ok]] - voiced[first[ok]]) * dx
+    variability[ok] = (cum_slope[last[ok]] - cum_slope[first[ok]]) / span
+    return variability
+
+
+def track_centre_of_gravity(track, starts, ends):
+    """
+    Centre of gravity of all segments from the short-time spectral moments.
+    The power spectra of the frames inside a segment are summed, weighted by
+    the squared Hanning window over the segment that the Praat script applies
+    before 'To Spectrum'. Segments without frames get the frame nearest to
+    their midpoint.
+    """
+    x1, dx, moments = track
+    times = frame_times(track)
+    if len(times) == 0:
+        return np.full(len(starts), np.nan)
+    lo = np.searchsorted(times, starts, side='left')
+    hi = np.searchsorted(times, ends, side='right')
+    nearest = np.clip(np.round(((starts + ends) / 2 - x1) / dx).astype(int), 0, len(times) - 1)
+    lo, hi = np.where(hi > lo, lo, nearest), np.where(hi > lo, hi, nearest + 1)
+
+    # One (segment, frame) pair for every frame of every segment
+    counts = hi - lo
+    segment = np.repeat(np.arange(len(starts)), counts)
+    frame = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        phase = np.clip((times[frame] - starts[segment]) / (ends - starts)[segment], 0.0, 1.0)
+    weight = np.where(np.repeat(counts == 1, counts), 1.0, np.sin(np.pi * phase) ** 4)
+
+    power = np.bincount(segment, weight * moments[0, frame], minlength=len(starts))
+    weighted = np.bincount(segment, weight * moments[1, frame], minlength=len(starts))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(power > 0, weighted / power, np.nan)
+
+
+def compute_segment_features(sound, tracks, starts, ends, settings=DEFAULT_SETTINGS, measures='segment', profile=None):
+    """
+    Compute all features of LabeledSegmentsAnalysis_v3.praat for the given
+    segments. Returns a dict with an array per column of FEATURE_COLUMNS.
+    With measures='segment', pitch variability and centre of gravity are
+    computed with a new analysis per segment, as the Praat script does. With
+    measures='whole_file' they come from the whole-file tracks instead.
+    The per-segment analyses are timed as the stage 'segment_extract', the
+    rest as 'segment_stats'.
+    """
+    with stage(profile, 'segment_stats'):
+        features = _track_features(tracks, starts, ends, measures)
+
+    if measures != 'whole_file':
+        with stage(profile, 'segment_extract'):
+            features['pitch_var'] = np.array([pitch_variability(sound, b, e, settings) for b, e in zip(starts, ends)])
+            features['grav_center'] = np.array([centre_of_gravity(sound, b, e) for b, e in zip(starts, ends)])
+
+    return {column: features[column] for column in FEATURE_COLUMNS}
+
+
+def _track_features(tracks, starts, ends, measures):
+    # All features that come from the whole-file tracks
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+    xmin, xmax = tracks['xmin'], tracks['xmax']
+    features = {'dur': (ends - starts) * 1000}
+
+    pitch_min, pitch_max, pitch_mean, pitch_std = window_statistics(
+        tracks['pitch'], starts, ends, xmin, xmax, sampled=True)
+    # Undefined pitch values are written as 0 by the Praat script
+    pitch_min = np.nan_to_num(pitch_min, nan=0.0)
+    pitch_max = np.nan_to_num(pitch_max, nan=0.0)
+    pitch_mean = np.nan_to_num(pitch_mean, nan=0.0)
+    pitch_std[pitch_min == pitch_max] = 0.0
+    features.update(pitch_min=pitch_min, pitch_max=pitch_max, pitch_mean=pitch_mean, pitch_std=pitch_std)
+
+    if measures == 'whole_file':
+        features['pitch_var'] = track_pitch_variability(tracks['pitch'], starts, ends)
+
+    intensity_min, intensity_max, intensity_mean, intensity_std = window_statistics(
+        tracks['intensity'], starts, ends, xmin, xmax, energy=True)
+    features.update(intensity_min=intensity_min, intensity_max=intensity_max,
+                    intensity_mean=intensity_mean, intensity_std=intensity_std)
+
+    formants = value_at_time(tracks['formant'], (starts + ends) / 2, xmin, xmax)
+    for i, column in enumerate(['f0', 'f1', 'f2', 'f3']):
+        features[column] = formants[i]
+
+    if measures == 'whole_file':
+        features['grav_center'] = track_centre_of_gravity(tracks['spectrum'], starts, ends)
+    return features
+
+
+def format_value(value, decimals):
+    """Format a number like Praat's 'value:decimals' interpolation."""
+    if value is None or np.isnan(value):
+        return '--undefined--'
+    return f'{value:.{decimals}f}'
+
+
+def format_result(header, soundname, labels, features):
+    """
+    Build the content of a result file in the layout of the Praat script: a
+    header line, then one line with the sound name, per segment the label
+    before every feature group, and the total number and duration of segments.
+    """
+    groups = [(['dur'], 0), (['pitch_min', 'pitch_max', 'pitch_mean', 'pitch_std'], 2), (['pitch_var'], 2),
+              (['intensity_min', 'intensity_max', 'intensity_mean', 'intensity_std'], 2),
+              (['f0', 'f1', 'f2', 'f3'], 0), (['grav_center'], 0)]
+    parts = [header, '\n\n', soundname]
+    for i, label in enumerate(labels):
+        for columns, decimals in groups:
+            parts.append(' ' + label)
+            for column in columns:
+                parts.append(' ' + format_value(features[column][i], decimals))
+    total_duration = float(np.sum(features['dur'])) if len(labels) else 0.0
+    parts.append(f' tot_int {len(labels)} tot_dur {total_duration:.0f}')
+    return ''.join(parts)
+
+
+def load_sound(audio_file, audio_cache=None):
+    if audio_cache is not None:
+        return audio_cache.sound(audio_file)
+    return parselmouth.Sound(audio_file)
+
+
+def segment_windows(starts, ends, window):
+    """
+    Divide the segments into consecutive windows of at most `window` seconds,
+    from the start of the first segment to the end of the last one. A window
+    only ends between segments, never inside one, so overlapping segments
+    (e.g. of several tiers) are always in the same window and a segment longer
+    than `window` gets a longer window. Returns an array of segment indices
+    per window.
+    """
+    order = np.argsort(starts, kind='stable')
+    windows = []
+    first = 0
+    window_start = window_end = None
+    for i, index in enumerate(order):
+        if window_start is not None and starts[index] >= window_end and max(window_end, ends[index]) - window_start > window:
+            windows.append(order[first:i])
+            first = i
+            window_start = None
+        if window_start is None:
+            window_start, window_end = starts[index], ends[index]
+        window_end = max(window_end, ends[index])
+    if len(order):
+        windows.append(order[first:])
+    return windows
+
+
+def _analyze_windowed(audio_file, segments, settings, measures, audio_cache, window, profile):
+    """
+    Analyse the segments of all tiers window by window (see segment_windows).
+    Only the audio of one window (plus WINDOW_MARGIN at both sides) and its
+    tracks are in memory at a time: the audio is opened as a LongSound and
+    every window is read from disk when it is analysed. The analysis frames
+    of every window are those of the whole recording (see analyze_audio), so
+    the features are the ones of a whole-file analysis, up to the small
+    differences that the pitch path and the resampling for the formants pick
+    up from the audio outside the window.
+    """
+    with stage(profile, 'decode'):
+        long_sound = call('Open long sound file', audio_cache.path(audio_file) if audio_cache is not None else audio_file)
+        xmin, xmax = call(long_sound, 'Get start time'), call(long_sound, 'Get end time')
+        number_of_samples = call(long_sound, 'Get number of samples')
+        sampling_period = call(long_sound, 'Get sampling period')
+    # Windows start at a multiple of the frame step of the spectral moments, so their frames are the ones of the whole recording too
+    step_samples = max(1, int(round(SPECTRUM_TIME_STEP / sampling_period)))
+
+    tiers = list(segments)
+    starts = np.concatenate([np.asarray(segments[tier][0], dtype=float) for tier in tiers]) if tiers else np.zeros(0)
+    ends = np.concatenate([np.asarray(segments[tier][1], dtype=float) for tier in tiers]) if tiers else np.zeros(0)
+    features = {column: np.full(len(starts), np.nan) for column in FEATURE_COLUMNS}
+    for indices in segment_windows(starts, ends, window):
+        first = max(0, int((starts[indices].min() - WINDOW_MARGIN - xmin) / sampling_period) // step_samples * step_samples)
+        last = min(number_of_samples, int(np.ceil((ends[indices].max() + WINDOW_MARGIN - xmin) / sampling_period)))
+        with stage(profile, 'decode'):
+            sound = call(long_sound, 'Extract part', xmin + first * sampling_period, xmin + last * sampling_period, 'yes')
+        tracks = analyze_audio(sound, settings, measures, profile, recording=(xmin, xmax, number_of_samples))
+        window_features = compute_segment_features(sound, tracks, starts[indices], ends[indices], settings, measures, profile)
+        for column in FEATURE_COLUMNS:
+            features[column][indices] = window_features[column]
+
+    results = {}
+    offset = 0
+    for tier in tiers:
+        tier_starts, tier_ends, labels = segments[tier]
+        results[tier] = (tier_starts, tier_ends, labels,
+                         {column: values[offset:offset + len(labels)] for column, values in features.items()})
+        offset += len(labels)
+    return results, xmax - xmin
+
+
+def recording_analysis(audio_file, settings=DEFAULT_SETTINGS, measures='segment', audio_cache=None, track_cache=None,
+                       profile=None):
+    """
+    The (resampled) sound and the analysis tracks of one audio file: what
+    compute_segment_features needs for any segments of the recording. The
+    tracks are read from the track cache if possible. The audio is only
+    decoded when it is needed, otherwise the sound is None (measures='whole_file'
+    with cached tracks).
+    """
+    mono = audio_cache is not None
+    tracks = None
+    if track_cache is not None:
+        with stage(profile, 'track_cache'):
+            tracks = track_cache.load(audio_file, settings, measures, mono)
+    sound = None
+    if tracks is None or measures == 'segment':
+        with stage(profile, 'decode'):
+            sound = load_sound(audio_file, audio_cache)
+        with stage(profile, 'resample'):
+            sound = resample_for_analysis(sound, settings)
+    if tracks is None:
+        tracks = analyze_audio(sound, settings, measures, profile)
+        if track_cache is not None:
+            with stage(profile, 'track_cache'):
+                track_cache.save(audio_file, settings, measures, tracks, mono)
+    return sound, tracks
+
+
+def analyze_segments(audio_file, textgrid_file, tier_numbers, match_label='*', begin_end_labels='SIL',
+                     settings=DEFAULT_SETTINGS, measures='segment', audio_cache=None, track_cache=None, profile=None,
+                     window=None):
+    """
+    Analyse one audio file for every tier in tier_numbers of its TextGrid. The
+    audio is analysed once for all tiers. Returns a dict from tier number to
+    (starts, ends, labels, features) of the selected segments.
+
+    With a window (in seconds), the recording is not analysed as a whole but
+    in windows of about that length around the segments, so memory use does
+    not grow with the length of the recording (see _analyze_windowed). The
+    track cache is not used then.
+
+    With an analysis rate in settings (see analysis_rate), the audio is
+    resampled once after decoding, and all analyses run on the resampled
+    sound.
+
+    With an AudioCache (see audio_cache.py), the decoded audio is read from the
+    cache. With a TrackCache (see track_cache.py), the analysis tracks are read
+    from the cache when they were computed before; with measures='whole_file'
+    the audio is then not needed at all.
+
+    With a RecordingProfile (see profiling.py), every stage is timed and the
+    audio duration and number of segments are stored in it.
+    """
+    with stage(profile, 'textgrid'):
+        textgrid = load_textgrid(textgrid_file)
+        segments = {tier_number: textgrid.segments(tier_number, match_label, begin_end_labels)
+                    for tier_number in tier_numbers}
+
+    if window is not None:
+        if analysis_rate(settings) is not None:
+            raise ValueError('A windowed analysis cannot resample the audio to an analysis rate')
+        results, audio_duration = _analyze_windowed(audio_file, segments, settings, measures, audio_cache, window, profile)
+        if profile is not None:
+            profile.values['audio_duration'] = audio_duration
+            profile.values['segments'] = sum(len(labels) for starts, ends, labels in segments.values())
+        return results
+
+    sound, tracks = recording_analysis(audio_file, settings, measures, audio_cache, track_cache, profile)
+
+    results = {}
+    for tier_number, (starts, ends, labels) in segments.items():
+        features = compute_segment_features(sound, tracks, starts, ends, settings, measures, profile)
+        results[tier_number] = (starts, ends, labels, features)
+
+    if profile is not None:
+        profile.values['audio_duration'] = tracks['xmax'] - tracks['xmin']
+        profile.values['segments'] = sum(len(labels) for starts, ends, labels in segments.values())
+    return results
+
+
+def write_result(result_file, header, soundname, starts, ends, labels, features):
+    """
+    Write the features of one recording. A .txt result file gets the layout of
+    the Praat script, a .npz or .parquet result file becomes a segment table
+    (see segment_tables.py).
+    """
+    if result_file.endswith('.txt'):
+        with open(result_file, 'w') as f:
+            f.write(format_result(header, soundname, labels, features))
+    else:
+        write_segment_table(result_file, segment_table(soundname, starts, ends, labels, features))
+
+
+def analyze_file(audio_file, textgrid_file, result_files, input_files, match_label='*', begin_end_labels='SIL',
+                 settings=DEFAULT_SETTINGS, measures='segment', audio_cache=None, track_cache=None, profile=None,
+                 window=None):
+    """
+    Analyse one audio file (see analyze_segments) and write a result file for
+    every tier of its TextGrid in result_files (a dict from tier number to
+    result file). input_files (the audio directory and file pattern) is
+    written in the header line, as the Praat script does.
+    """
+    soundname = os.path.splitext(os.path.basename(audio_file))[0]
+    results = analyze_segments(audio_file, textgrid_file, list(result_files), match_label, begin_end_labels,
+                               settings, measures, audio_cache, track_cache, profile, window)
+    with stage(profile, 'write'):
+        for tier_number, result_file in result_files.items():
+            header = f'{input_files}, Tier number {tier_number}'
+            write_result(result_file, header, soundname, *results[tier_number])
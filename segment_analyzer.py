@@ -0,0 +1,124 @@
+"""
+In-process queries of segment features, for exploratory work (e.g. in
+run_LabeledSegmentsAnalysis_v3.ipynb).
+
+    from segment_analyzer import SegmentAnalyzer
+    analyzer = SegmentAnalyzer()
+    analyzer.features('audio/10101_posttest0_11.mp3', [(0.31, 0.52, 'de'), (0.52, 1.04, 'hallo')])
+
+A SegmentAnalyzer computes the features of arbitrary segments (start and end
+in seconds, and a label) of a recording with the parselmouth engine (see
+segment_analysis.py), without TextGrids or result files. The returned
+DataFrame has a row per segment with the columns word, start, end, the
+feature columns of organizing_PraatFeatures.py and file_name.
+
+The Pitch, Intensity and Formant tracks and the decoded sound of a recording
+do not depend on the segments. They are kept in memory for the most recently
+used recordings, so further queries on the same recordings (other alignments,
+ASR variants, manual corrections) only compute the segment statistics. When
+the kept recordings take more than max_bytes, the least recently used ones are
+dropped; the last one is always kept. A recording is analysed again when its
+audio file changed.
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from manifest import file_identity
+from segment_analysis import DEFAULT_SETTINGS, compute_segment_features, recording_analysis
+from segment_tables import FEATURE_COLUMNS
+from textgrid_index import load_textgrid
+
+
+ANALYZER_COLUMNS = ['word', 'start', 'end'] + FEATURE_COLUMNS + ['file_name']
+
+
+def analysis_nbytes(sound, tracks):
+    """Memory taken by the sound and the track arrays of one recording."""
+    nbytes = sound.values.nbytes if sound is not None else 0
+    for track in tracks.values():
+        if isinstance(track, tuple):
+            nbytes += sum(np.asarray(part).nbytes for part in track)
+    return nbytes
+
+
+class SegmentAnalyzer:
+    """
+    Features of segments of recordings, with the analyses of the recordings
+    kept in an LRU cache of at most max_bytes. settings and measures are
+    the ones of segment_analysis.analyze_segments (e.g. an analysis rate in
+    settings). With an AudioCache or TrackCache, recordings that are not in
+    memory are read from them.
+    """
+
+    def __init__(self, settings=DEFAULT_SETTINGS, measures='segment', max_bytes=2 * 1024 ** 3, audio_cache=None, track_cache=None):
+        self.settings = settings
+        self.measures = measures
+        self.max_bytes = max_bytes
+        self.audio_cache = audio_cache
+        self.track_cache = track_cache
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._recordings = OrderedDict()
+
+    def analysis(self, audio_file):
+        """The sound (None with measures='whole_file') and tracks of audio_file, from memory if possible."""
+        path = os.path.abspath(audio_file)
+        identity = file_identity(path)
+        entry = self._recordings.get(path)
+        if entry is not None and entry[0] == identity:
+            self._recordings.move_to_end(path)
+            self.hits += 1
+            return entry[1], entry[2]
+
+        self.misses += 1
+        self.forget(path)
+        sound, tracks = recording_analysis(path, self.settings, self.measures, self.audio_cache, self.track_cache)
+        if self.measures != 'segment':
+            # The whole-file measures only need the tracks
+            sound = None
+        nbytes = analysis_nbytes(sound, tracks)
+        self._recordings[path] = (identity, sound, tracks, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes and len(self._recordings) > 1:
+            self.forget(next(iter(self._recordings)))
+        return sound, tracks
+
+    def forget(self, audio_file=None):
+        """Drop the analysis of audio_file from memory, or of all recordings if not given."""
+        paths = list(self._recordings) if audio_file is None else [os.path.abspath(audio_file)]
+        for path in paths:
+            entry = self._recordings.pop(path, None)
+            if entry is not None:
+                self.nbytes -= entry[3]
+
+    def features(self, audio_file, segments):
+        """
+        Features of segments of audio_file. segments is a list of (start, end,
+        label) with the times in seconds, or a DataFrame with the columns
+        start, end and word (e.g. the rows of one recording of a feature table).
+        """
+        if isinstance(segments, pd.DataFrame):
+            starts, ends, labels = segments['start'], segments['end'], segments['word']
+        else:
+            starts, ends, labels = zip(*segments) if len(segments) else ((), (), ())
+        starts = np.asarray(starts, dtype=float)
+        ends = np.asarray(ends, dtype=float)
+        if np.any(ends < starts):
+            raise ValueError('Every segment must end after its start')
+
+        sound, tracks = self.analysis(audio_file)
+        features = compute_segment_features(sound, tracks, starts, ends, self.settings, self.measures)
+        table = {'word': np.asarray(labels, dtype=object), 'start': starts, 'end': ends}
+        table.update(features)
+        table['file_name'] = os.path.splitext(os.path.basename(audio_file))[0]
+        return pd.DataFrame(table, columns=ANALYZER_COLUMNS)
+
+    def textgrid_features(self, audio_file, textgrid_file, tier_number=2, match_label='*', begin_end_labels='SIL'):
+        """Features of the segments of a tier of a TextGrid, selected as in LabeledSegmentsAnalysis_v3.praat."""
+        starts, ends, labels = load_textgrid(textgrid_file).segments(tier_number, match_label, begin_end_labels)
+        return self.features(audio_file, list(zip(starts, ends, labels)))
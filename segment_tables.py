@@ -0,0 +1,57 @@
+"""
+Columnar per-segment result files.
+
+Instead of one whitespace-joined line per recording (as written by the Praat
+script), the features of a recording are stored as a typed table with one row
+per segment and explicit columns for the file name, segment index, label,
+start and end time and every feature. Tables are written as .npz (NumPy only)
+or .parquet (needs pyarrow), and can be read back without any text parsing.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+FEATURE_COLUMNS = ['dur', 'pitch_min', 'pitch_max', 'pitch_mean', 'pitch_std', 'pitch_var',
+                   'intensity_min', 'intensity_max', 'intensity_mean', 'intensity_std',
+                   'f0', 'f1', 'f2', 'f3', 'grav_center']
+
+TABLE_COLUMNS = ['file_name', 'segment', 'word', 'start', 'end'] + FEATURE_COLUMNS
+
+TABLE_EXTENSIONS = {'npz': '.npz', 'parquet': '.parquet'}
+
+
+def segment_table(file_name, starts, ends, labels, features):
+    """Return the columns of a segment table as a dict of typed NumPy arrays."""
+    n = len(labels)
+    table = {
+        'file_name': np.full(n, file_name, dtype=str),
+        'segment': np.arange(1, n + 1, dtype=np.int32),
+        'word': np.asarray(labels, dtype=str),
+        'start': np.asarray(starts, dtype=np.float64),
+        'end': np.asarray(ends, dtype=np.float64),
+    }
+    for column in FEATURE_COLUMNS:
+        table[column] = np.asarray(features[column], dtype=np.float64)
+    return table
+
+
+def write_segment_table(path, table):
+    if path.endswith('.npz'):
+        # Open the file ourselves, otherwise numpy appends another .npz
+        with open(path, 'wb') as f:
+            np.savez(f, **table)
+    elif path.endswith('.parquet'):
+        pd.DataFrame(table, columns=TABLE_COLUMNS).to_parquet(path, index=False)
+    else:
+        raise ValueError(f'Unknown segment table format: {path}')
+
+
+def read_segment_table(path):
+    """Read a segment table written by write_segment_table as a DataFrame."""
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            return pd.DataFrame({column: data[column] for column in TABLE_COLUMNS})
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    raise ValueError(f'Unknown segment table format: {path}')
@@ -0,0 +1,182 @@
+"""
+Deterministic partitioning of a corpus over shards, for cluster array jobs.
+
+With --shard i/N, a driver only processes shard i (0 .. N-1) of N. Every
+shard computes the same partition on its own, without any communication: the
+recordings are sorted by weight (audio duration or file size) and name, and
+each is given to the shard with the least total weight so far (largest
+first). The shards then take about the same time, also when the recordings
+differ a lot in length.
+
+Every shard writes its own output (a result directory next to the output
+directory, or a table next to the output table), so shards never write to the
+same file. merge_shards.py checks that every recording was processed by
+exactly one shard and combines the shards.
+"""
+
+import heapq
+import os
+import shutil
+
+import pandas as pd
+
+from feature_tables import read_table, write_table
+from manifest import append_manifest, load_manifest, manifest_path
+from textgrid_index import textgrid_domain
+
+
+# What the shards are balanced on
+BALANCE = ['duration', 'size']
+
+
+def parse_shard(text):
+    """'i/N' -> (i, N), where 0 <= i < N."""
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f'--shard must be i/N, e.g. 0/8, not {text}')
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'The shard index must be between 0 and {count - 1}, not {index}')
+    return index, count
+
+
+def file_size(path):
+    # Missing files get weight 0, their job fails in whichever shard it lands
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def recording_weights(audio_files, textgrid_files, balance='duration'):
+    """
+    The weight of every recording: its duration (of the TextGrid, which covers
+    the audio) or the size of its audio file. Every shard task computes the
+    weights of the whole corpus, so only the header of every TextGrid is read.
+    """
+    if balance == 'size':
+        return [file_size(audio_file) for audio_file in audio_files]
+    weights = []
+    for textgrid_file in textgrid_files:
+        try:
+            xmin, xmax = textgrid_domain(textgrid_file)
+            weights.append(xmax - xmin)
+        except Exception:
+            weights.append(0.0)
+    return weights
+
+
+def shard_assignment(names, weights, count):
+    """
+    The shard of every name: the heaviest recordings are placed first, each on
+    the shard with the least total weight (ties go to the lowest shard). Only
+    depends on the names and weights, not on their order.
+    """
+    loads = [(0.0, shard) for shard in range(count)]
+    assignment = {}
+    for weight, name in sorted(zip(weights, names), key=lambda item: (-item[0], item[1])):
+        load, shard = heapq.heappop(loads)
+        assignment[name] = shard
+        heapq.heappush(loads, (load + weight, shard))
+    return [assignment[name] for name in names]
+
+
+def select_shard(items, names, weights, shard):
+    """The items (in their original order) that belong to shard (index, count)."""
+    index, count = shard
+    return [item for item, item_shard in zip(items, shard_assignment(names, weights, count)) if item_shard == index]
+
+
+def shard_name(index, count):
+    return f'shard-{index}-of-{count}'
+
+
+def shard_dir(output_dir, index, count):
+    # lsa-feature-files -> lsa-feature-files.shard-0-of-8, next to the output directory (as the manifest)
+    return os.path.normpath(output_dir) + '.' + shard_name(index, count)
+
+
+def shard_table_path(path, index, count):
+    # eGeMAPS_wordlevel_Reference.parquet -> eGeMAPS_wordlevel_Reference.shard-0-of-8.parquet
+    root, extension = os.path.splitext(path)
+    return f'{root}.{shard_name(index, count)}{extension}'
+
+
+def check_shards(expected, found):
+    """
+    found is a dict from shard index to the recordings that shard processed.
+    Returns the expected recordings that no shard processed, and the
+    recordings that were processed by more than one shard (with their shards).
+    """
+    shards_of = {}
+    for index, recordings in sorted(found.items()):
+        for recording in recordings:
+            shards_of.setdefault(recording, []).append(index)
+    missing = sorted(set(expected) - set(shards_of))
+    duplicates = {recording: shards for recording, shards in sorted(shards_of.items()) if len(shards) > 1}
+    return missing, duplicates
+
+
+def shard_report(missing, duplicates):
+    lines = []
+    if missing:
+        lines.append(f'{len(missing)} recordings are missing: {", ".join(missing)}')
+    for recording, shards in duplicates.items():
+        lines.append(f'{recording} is in shards {", ".join(str(shard) for shard in shards)}')
+    return '\n'.join(lines)
+
+
+def merge_result_dirs(output_dir, count, expected, allow_missing=False):
+    """
+    Move the result files of the shard directories of output_dir into output_dir
+    and append their manifest entries to its manifest. The recordings of a shard
+    are the ones in its manifest, i.e. the ones that were analysed successfully.
+    Recordings in the manifest of output_dir were merged before (shard runs skip
+    them) and are not missing.
+    Raises ValueError (before anything is moved) if recordings are in several
+    shards, or are missing and allow_missing is False. Returns the missing recordings.
+    """
+    directories = {index: shard_dir(output_dir, index, count) for index in range(count)}
+    manifests = {index: load_manifest(manifest_path(directory)) for index, directory in directories.items()}
+    missing, duplicates = check_shards(expected, {index: list(manifest) for index, manifest in manifests.items()})
+    merged = load_manifest(manifest_path(output_dir))
+    missing = [recording for recording in missing if recording not in merged]
+    if duplicates or (missing and not allow_missing):
+        raise ValueError('The shards are not complete:\n' + shard_report(missing, duplicates))
+
+    os.makedirs(output_dir, exist_ok=True)
+    for index, directory in directories.items():
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.listdir(directory):
+            os.replace(os.path.join(directory, entry), os.path.join(output_dir, entry))
+        for recording, key in manifests[index].items():
+            append_manifest(manifest_path(output_dir), recording, key)
+        shutil.rmtree(directory)
+        if os.path.exists(manifest_path(directory)):
+            os.remove(manifest_path(directory))
+    return missing
+
+
+def merge_tables(path, count, expected, name_column='name', allow_missing=False):
+    """
+    Concatenate the shard tables of the table at path (in shard order) and
+    write the table. The recordings of a shard are the values of name_column.
+    Raises ValueError if a shard table does not exist, if recordings are in
+    several shards, or are missing and allow_missing is False. Returns the
+    missing recordings.
+    """
+    tables = {}
+    for index in range(count):
+        shard_path = shard_table_path(path, index, count)
+        if not os.path.exists(shard_path):
+            raise ValueError(f'Shard {index} of {count} has no table {shard_path}')
+        tables[index] = read_table(shard_path)
+    # An empty shard table has no columns
+    missing, duplicates = check_shards(expected, {index: table[name_column].unique() if name_column in table else []
+                                                  for index, table in tables.items()})
+    if duplicates or (missing and not allow_missing):
+        raise ValueError('The shards are not complete:\n' + shard_report(missing, duplicates))
+
+    write_table(pd.concat(tables.values(), ignore_index=True), path)
+    return missing
@@ -0,0 +1,221 @@
+"""
+Indexed TextGrids with vectorized segment selection.
+
+Selecting segments through the Praat interpreter costs one call per interval
+or point (Get label of interval, Get starting point, ...). Here a TextGrid is
+read once into NumPy arrays: per tier the start and end times and a label
+code per interval or point, where the codes index the sorted unique labels of
+the TextGrid. The selection rules of LabeledSegmentsAnalysis_v3.praat
+(match_label, skipping silence labels, pairing of begin and end labels on
+point tiers) are then evaluated once per unique label and applied to all
+intervals at once.
+
+load_textgrid keeps the indexes of the most recently used TextGrids in memory,
+so the parselmouth engine (segment_analysis.py) and the openSMILE pipeline
+(GeMAPS/ExtractingFeatures_openSMILE.py) read every TextGrid only once per
+process.
+"""
+
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from manifest import file_identity
+
+
+# Labels that are skipped when match_label is '*'
+SILENCE_LABELS = ('', '<SIL>', 'SIL', '<SPN>', '[SPN]')
+
+# Number of TextGrid indexes kept in memory by load_textgrid
+TEXTGRID_CACHE_SIZE = 256
+
+# Bytes read by textgrid_domain, enough for the header of a text TextGrid in any encoding
+HEADER_SIZE = 4096
+
+# Tokens of the (long or short) text format: strings ("" is a quote inside a
+# string), numbers and flags. Indices such as [1] are matched outside the group,
+# so they give empty tokens
+TOKEN_PATTERN = re.compile(r'\[[^\]"]*\]|("[^"]*(?:""[^"]*)*"|<[a-z]+>|[-+.\d][^\s"]*)')
+
+
+def _extract_word(text, after):
+    """Equivalent of Praat's extractWord$: the word following the first occurrence of `after`."""
+    index = text.find(after)
+    if index < 0:
+        return ''
+    words = text[index + len(after):].split()
+    return words[0] if words else ''
+
+
+def _decode(data):
+    if data.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return data.decode('utf-16')
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def _text_tokens(path):
+    with open(path, 'rb') as f:
+        tokens = list(filter(None, TOKEN_PATTERN.findall(_decode(f.read()))))
+    if tokens[:2] == ['"ooTextFile"', '"TextGrid"']:
+        return tokens
+
+    # Binary and other formats: let Praat convert the TextGrid to the text format
+    import parselmouth
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        text_file = os.path.join(temporary_dir, 'textgrid.TextGrid')
+        parselmouth.read(path).save_as_text_file(text_file)
+        return _text_tokens(text_file)
+
+
+def _strings(tokens):
+    return [token[1:-1].replace('""', '"') for token in tokens]
+
+
+class TextGridIndex:
+    """
+    All tiers of a TextGrid as NumPy arrays. Every tier is a dict with its
+    name, whether it is an interval tier, and the arrays starts, ends (equal to
+    starts for the points of a point tier) and codes, the index of the label
+    of every interval or point in `labels`.
+    """
+
+    def __init__(self, xmin, xmax, tiers, labels):
+        self.xmin = xmin
+        self.xmax = xmax
+        self.tiers = tiers
+        self.labels = labels
+
+    @classmethod
+    def read(cls, path):
+        tokens = _text_tokens(path)
+        xmin, xmax = float(tokens[2]), float(tokens[3])
+        position = 4
+        tiers = []
+        raw_labels = []
+        if tokens[position] == '<exists>':
+            number_of_tiers = int(tokens[position + 1])
+            position += 2
+            for _ in range(number_of_tiers):
+                tier_class, name = _strings(tokens[position:position + 2])
+                count = int(tokens[position + 4])
+                position += 5
+                interval = tier_class == 'IntervalTier'
+                width = 3 if interval else 2
+                rows = np.array(tokens[position:position + width * count], dtype=object).reshape(count, width)
+                position += width * count
+                starts = rows[:, 0].astype(float)
+                ends = rows[:, 1].astype(float) if interval else starts
+                tiers.append({'name': name, 'interval': interval, 'starts': starts, 'ends': ends})
+                raw_labels.append(rows[:, -1])
+
+        # Every distinct label is decoded once
+        unique, codes = np.unique(np.concatenate(raw_labels) if raw_labels else np.zeros(0, dtype=object), return_inverse=True)
+        labels = np.array(_strings(unique), dtype=object)
+        offset = 0
+        for tier in tiers:
+            tier['codes'] = codes[offset:offset + len(tier['starts'])]
+            offset += len(tier['starts'])
+        return cls(xmin, xmax, tiers, labels)
+
+    def tier(self, tier_number):
+        if not 1 <= tier_number <= len(self.tiers):
+            raise ValueError(f'The TextGrid has no tier {tier_number}, it has {len(self.tiers)} tiers')
+        return self.tiers[tier_number - 1]
+
+    def label_mask(self, condition):
+        # condition evaluated once per distinct label, as an array indexed by label code
+        return np.array([condition(label) for label in self.labels], dtype=bool)
+
+    def segments(self, tier_number, match_label='*', begin_end_labels='SIL'):
+        """
+        Select the segments to analyse from a tier, following the selection
+        rules of ComputeAnalysis in the Praat script.
+
+        Returns three arrays: start times, end times and segment labels.
+        """
+        tier = self.tier(tier_number)
+        starts, ends, codes = tier['starts'], tier['ends'], tier['codes']
+
+        if tier['interval']:
+            interval = _extract_word(match_label, '')
+            matches = self.label_mask(lambda label: (interval in label and interval != '') or interval == '#' or
+                                      (interval == '*' and label not in SILENCE_LABELS))
+            # The first and the last interval are never analysed
+            selected = matches[codes]
+            selected[[0, -1] if len(selected) else []] = False
+            return starts[selected], ends[selected], self.labels[codes[selected]]
+
+        start_label = _extract_word(begin_end_labels, '')
+        end_label = _extract_word(begin_end_labels, '-')
+        labels = self.labels[codes]
+        if start_label == '#' and end_label == '#':
+            # Every pair of consecutive points
+            return starts[:-1], starts[1:], labels[:-1] + '-' + labels[1:]
+        if start_label != '#' and end_label != '#':
+            # As the loop in the Praat script: one segment from the first point with the begin label to
+            # the last later point with the end label, labelled with the labels of all those end points
+            begins = np.flatnonzero(self.label_mask(lambda label: start_label in label)[codes])
+            if len(begins):
+                first = begins[0]
+                end_points = first + 1 + np.flatnonzero(self.label_mask(lambda label: end_label in label)[codes[first + 1:]])
+                if len(end_points):
+                    label = '-'.join([labels[first]] + list(labels[end_points]))
+                    return np.array([starts[first]]), np.array([starts[end_points[-1]]]), np.array([label or '-'], dtype=object)
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=object)
+
+    def intervals(self, tier_number):
+        """
+        The start times, end times and labels of the intervals of a tier that
+        have a label. As praatio reads TextGrids, the labels are stripped of
+        surrounding whitespace, and intervals without any other text are left out.
+        """
+        tier = self.tier(tier_number)
+        stripped = np.array([label.strip() for label in self.labels], dtype=object)
+        selected = (stripped != '')[tier['codes']]
+        return tier['starts'][selected], tier['ends'][selected], stripped[tier['codes'][selected]]
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def load_textgrid(path):
+    """
+    The TextGridIndex of the TextGrid at path. The indexes of the last
+    TEXTGRID_CACHE_SIZE TextGrids are kept in memory and used again as long
+    as the file does not change. Safe to call from several threads.
+    """
+    key = os.path.abspath(path)
+    identity = file_identity(path)
+    with _cache_lock:
+        if key in _cache and _cache[key][0] == identity:
+            _cache.move_to_end(key)
+            return _cache[key][1]
+
+    index = TextGridIndex.read(path)
+    with _cache_lock:
+        _cache[key] = (identity, index)
+        if len(_cache) > TEXTGRID_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return index
+
+
+def textgrid_domain(path):
+    """
+    (xmin, xmax) of the TextGrid at path, from the header only, so the tiers
+    are not read. Binary TextGrids are read completely (see load_textgrid).
+    """
+    with open(path, 'rb') as f:
+        tokens = list(filter(None, TOKEN_PATTERN.findall(_decode(f.read(HEADER_SIZE)))))
+    if tokens[:2] == ['"ooTextFile"', '"TextGrid"'] and len(tokens) >= 4:
+        return float(tokens[2]), float(tokens[3])
+    textgrid = load_textgrid(path)
+    return textgrid.xmin, textgrid.xmax
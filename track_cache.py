@@ -0,0 +1,66 @@
+"""
+On-disk cache of the analysis tracks of a recording.
+
+The Pitch, Intensity and Formant tracks (and the spectral moments of
+--measures whole_file) only depend on the audio and the analysis settings, not
+on the tier, match label or begin/end labels. This cache stores the frame
+arrays computed by segment_analysis.analyze_audio as an .npz file per
+recording, keyed on the content hash of the audio file and the settings. As in
+audio_cache.py, the hashes are kept in an index in the cache directory, so an
+unchanged file is only hashed once. Re-runs with another tier, label filter or
+TextGrid variant over the same audio then only compute the segment statistics.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from audio_cache import HashIndex
+
+
+# Increase when the layout of the tracks changes, so old entries are not used
+TRACK_CACHE_VERSION = 2
+
+TRACK_NAMES = ['pitch', 'intensity', 'formant', 'spectrum']
+
+
+class TrackCache:
+    """Cache of analysis tracks in `directory`."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index = HashIndex(directory)
+
+    def path(self, audio_file, settings, measures, mono):
+        content = [TRACK_CACHE_VERSION, self.index.content_hash(audio_file), settings, measures, mono]
+        key = hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, audio_file, settings, measures, mono=False):
+        """The cached tracks of audio_file, None if they are not in the cache."""
+        path = self.path(audio_file, settings, measures, mono)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            tracks = {'xmin': float(data['xmin']), 'xmax': float(data['xmax'])}
+            for name in TRACK_NAMES:
+                if name + '_values' in data:
+                    tracks[name] = (float(data[name + '_x1']), float(data[name + '_dx']), data[name + '_values'])
+        return tracks
+
+    def save(self, audio_file, settings, measures, tracks, mono=False):
+        arrays = {'xmin': tracks['xmin'], 'xmax': tracks['xmax']}
+        for name in TRACK_NAMES:
+            if name in tracks:
+                arrays[name + '_x1'], arrays[name + '_dx'], arrays[name + '_values'] = tracks[name]
+
+        # Write to a temporary file first, so other workers never read a half-written entry
+        fd, temporary_file = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.chmod(temporary_file, 0o644)
+        os.replace(temporary_file, self.path(audio_file, settings, measures, mono))
@@ -21,6 +21,10 @@ tierNumber=2
 lsaFeatureTxtDir=$basePath/05_asr_experiments/whispert_dis_prompts/fluency-features/lsa-feature-files
 lsaFeatureTotalFile=$basePath/05_asr_experiments/whispert_dis_prompts/fluency-features/lsa-features-total.tsv
 calculateMean=false #if True, only the mean values per recording will be saved
+# Add e.g. --aggregate recording,session,participant to the organizer to also write summary tables per level (see README)
 
 python3 run_LabeledSegmentsAnalysis_v3.py --audioDir $audioDir --audioExtension '.mp3' --textGridDir $textGridDir --tierNumber $tierNumber --lsaFeatureTxtDir $lsaFeatureTxtDir
 python3 organizing_PraatFeatures.py --lsaFeatureTxtDir $lsaFeatureTxtDir --lsaFeatureTotalFile $lsaFeatureTotalFile --calculateMean $calculateMean
+
+# Alternatively, analyse the recordings and write lsaFeatureTotalFile in a single pass (no .txt files unless --lsaFeatureTxtDir is given):
+# python3 run_pipeline.py --audioDir $audioDir --audioExtension '.mp3' --textGridDir $textGridDir --tierNumber $tierNumber --lsaFeatureTotalFile $lsaFeatureTotalFile --workers 8